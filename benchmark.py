@@ -0,0 +1,309 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+
+import compactdata
+import generatecleandata
+import router
+import telemetry
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Headline metrics compared against a previous report with --compare (name -> whether higher is better)
+COMPARED_METRICS = {
+    "latency_ms.p50": False,
+    "latency_ms.p95": False,
+    "latency_ms.p99": False,
+    "ttft_ms.p50": False,
+    "prompts_per_sec": True,
+    "tokens.per_sec": True,
+    "accuracy.accuracy": True,
+}
+
+def load_corpus(path: str, agents: dict) -> list:
+    """
+    Reads `(prompt, reference agent or None)` pairs from:
+    - "builtin": the 50 prompts of `test.generate_user_inputs()`, unlabelled
+    - a compact training file or promptgen JSONL (`{"prompt", "agent"}` records)
+    - prompts.json, whose `agent: "prompt"` lines are parsed like generatecleandata.py does
+    """
+    if path == "builtin":
+        import test
+        return [(prompt, None) for prompt in test.generate_user_inputs()]
+    corpus = []
+    if path.endswith(".jsonl"):
+        for record in compactdata.iter_records(path):
+            if record.get("type") == "example":
+                corpus.append((compactdata.unwrap_input(record["input"]), record["agent"]))
+            elif "prompt" in record:
+                corpus.append((record["prompt"], record.get("agent")))
+        return corpus
+    matcher = generatecleandata.AgentMatcher(agents)
+    for raw_prompt in generatecleandata.iter_raw_prompts(path):
+        row, reason = generatecleandata.clean_prompt(raw_prompt, matcher)
+        if row is not None:
+            corpus.append((compactdata.unwrap_input(row["input"]), row["agent"]))
+        elif reason != "empty_input" and isinstance(raw_prompt, str):
+            corpus.append((raw_prompt.strip(), None))
+    return corpus
+
+def load_labels(path: str, backend: str = None) -> dict:
+    """Reference labels as prompt -> agent, from JSON ({prompt: agent}) or JSONL records (evaluate.py checkpoints included)."""
+    if not path.endswith(".jsonl"):
+        with open(path, "r") as f:
+            return json.load(f)
+    labels = {}
+    for record in compactdata.iter_records(path):
+        if backend is not None and record.get("backend") != backend:
+            continue
+        agent = record.get("agent", record.get("recommended_agent"))
+        if agent is not None:
+            labels[record["prompt"]] = agent
+    return labels
+
+class GpuMemoryMonitor:
+    """
+    Peak GPU memory during a run: the in-process torch allocator peak (local models), and the device-wide peak
+    sampled from nvidia-smi (which also covers a local Ollama server).
+    """
+
+    def __init__(self, interval_s: float = 0.25):
+        self.interval_s = interval_s
+        self.device_peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            try:
+                output = subprocess.run(
+                    ["nvidia-smi", "--query-gpu=memory.used", "--format=csv,noheader,nounits"],
+                    capture_output=True, text=True, timeout=5,
+                ).stdout
+                used = sum(float(line) for line in output.split() if line.strip())
+                self.device_peak_mb = max(self.device_peak_mb or 0.0, used)
+            except (OSError, ValueError, subprocess.SubprocessError):
+                return
+            self._stop.wait(self.interval_s)
+
+    def __enter__(self):
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if shutil.which("nvidia-smi"):
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def report(self) -> dict:
+        torch_peak = None
+        if torch is not None and torch.cuda.is_available():
+            torch_peak = torch.cuda.max_memory_allocated() / 2 ** 20
+        return {"torch_peak_mb": torch_peak, "device_peak_mb": self.device_peak_mb}
+
+def summarize(values: list, scale: float = 1000.0) -> dict:
+    """p50/p95/p99/mean/max of `values` (seconds), in milliseconds by default."""
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * scale
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99),
+            "mean": float(np.mean(values) * scale), "max": float(np.max(values) * scale), "count": len(values)}
+
+def run_benchmark(backend: router.Router, corpus: list, concurrency: int = 1, duration_s: float = None,
+                  batch_size: int = 1, warmup: int = 0, labels: dict = None) -> dict:
+    """
+    Drives `backend` with `concurrency` workers over `corpus` (one pass, or cycled until `duration_s` has elapsed).
+    With `batch_size` 1 every request is timed individually through `route_with_stats`; larger batches go through
+    `route_many` and each prompt is charged the whole batch's latency.
+    """
+    labels = dict(labels or {})
+    for prompt, agent in corpus:
+        if agent is not None:
+            labels.setdefault(prompt, agent)
+    prompts = [prompt for prompt, _ in corpus]
+    for prompt in prompts[:warmup]:
+        backend.route_many([prompt])
+
+    source = itertools.cycle(prompts) if duration_s else iter(prompts)
+    source_lock = threading.Lock()
+    samples = []
+    samples_lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration_s if duration_s else None
+
+    def next_batch() -> list:
+        with source_lock:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return []
+            return list(itertools.islice(source, batch_size))
+
+    def worker() -> None:
+        while True:
+            batch = next_batch()
+            if not batch:
+                return
+            request_start = time.perf_counter()
+            if batch_size == 1:
+                try:
+                    results, stats = backend.route_with_stats(batch[0])
+                    results, stats = [results], [stats]
+                except Exception as e:
+                    results, stats = [router.failed_response(e)], [{}]
+            else:
+                results = backend.route_many(batch)
+                stats = [{}] * len(batch)
+            latency = time.perf_counter() - request_start
+            with samples_lock:
+                for prompt, result, stat in zip(batch, results, stats):
+                    samples.append({
+                        "latency_s": latency,
+                        "ttft_s": stat.get("ttft_s"),
+                        "completion_tokens": stat.get("completion_tokens"),
+                        "error": result.get("error"),
+                        "agent": result.get("recommended_agent"),
+                        "reference": labels.get(prompt),
+                    })
+
+    with GpuMemoryMonitor() as monitor:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+    elapsed = time.perf_counter() - start
+
+    tokens = [sample["completion_tokens"] for sample in samples if sample["completion_tokens"] is not None]
+    labelled = [sample for sample in samples if sample["reference"] is not None]
+    correct = sum(sample["agent"] == sample["reference"] for sample in labelled)
+    return {
+        "requests": len(samples),
+        "errors": sum(sample["error"] is not None for sample in samples),
+        "elapsed_s": elapsed,
+        "prompts_per_sec": len(samples) / elapsed if elapsed else 0.0,
+        "latency_ms": summarize([sample["latency_s"] for sample in samples]),
+        "ttft_ms": summarize([sample["ttft_s"] for sample in samples]),
+        "tokens": {
+            "total": sum(tokens),
+            "per_request": sum(tokens) / len(tokens) if tokens else None,
+            "per_sec": sum(tokens) / elapsed if tokens and elapsed else None,
+        },
+        "gpu_memory": monitor.report(),
+        "accuracy": {
+            "labelled": len(labelled),
+            "correct": correct,
+            "accuracy": correct / len(labelled) if labelled else None,
+        },
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def metric(report: dict, name: str):
+    value = report
+    for part in name.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Relative change of each headline metric against `baseline`, flagged when it moved the wrong way."""
+    changes = {}
+    for name, higher_is_better in COMPARED_METRICS.items():
+        new, old = metric(report, name), metric(baseline, name)
+        if new is None or old is None or old == 0:
+            continue
+        change = (new - old) / abs(old)
+        changes[name] = {"baseline": old, "current": new, "change_pct": 100 * change,
+                         "regressed": change < 0 if higher_is_better else change > 0}
+    return changes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a router backend: latency percentiles, TTFT, throughput, GPU memory and accuracy.")
+    parser.add_argument("--backend", choices=sorted(router.BACKENDS), default="finetuned")
+    parser.add_argument("--model", help="Model name for the openai/ollama backends, or the GGUF export for cpu.")
+    parser.add_argument("--api-base", help="OpenAI-compatible endpoint, e.g. a local stub_server.py at http://127.0.0.1:8001/v1.")
+    parser.add_argument("--host", help="Ollama host, e.g. a local stub_server.py at http://127.0.0.1:8001.")
+    parser.add_argument("--threads", type=int, help="CPU threads for the cpu (llama.cpp) backend.")
+    parser.add_argument("--catalog", default="agents.json")
+    parser.add_argument("--prompts", default="prompts.json", help="prompts.json, a JSONL corpus, or 'builtin' for test.generate_user_inputs().")
+    parser.add_argument("--labels", help="Reference labels (JSON {prompt: agent}, or JSONL such as an evaluate.py checkpoint).")
+    parser.add_argument("--labels-backend", help="Only use this backend's answers from a checkpoint as labels, e.g. openai.")
+    parser.add_argument("--limit", type=int, help="Only use the first N prompts of the corpus.")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--duration", type=float, help="Seconds to run, cycling the corpus (default: one pass).")
+    parser.add_argument("--batch-size", type=int, default=1, help="Prompts per route_many call (1 times each request individually).")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", help="Where to save the JSON report (default: benchmarks/<backend>-<commit>.json).")
+    parser.add_argument("--compare", help="A previous report to compare the headline metrics against.")
+    parser.add_argument("--telemetry", help="Telemetry exporters, e.g. 'logging,prometheus=router_metrics.prom' (default: $ROUTER_TELEMETRY); "
+                                            "the per-span breakdown is added to the report.")
+    args = parser.parse_args()
+    if args.telemetry is not None:
+        telemetry.configure(args.telemetry)
+    else:
+        telemetry.configure_from_env()
+
+    with open(args.catalog, "r") as f:
+        agents = json.load(f)
+    backend_kwargs = {"agents": agents}
+    if args.model:
+        backend_kwargs["model"] = args.model
+    if args.backend == "ollama" and args.host:
+        backend_kwargs["host"] = args.host
+    if args.backend == "cpu" and args.threads:
+        backend_kwargs["n_threads"] = args.threads
+    if args.api_base:
+        openai.api_base = args.api_base
+        openai.api_key = openai.api_key or os.getenv("OPENAI_API_KEY") or "stub"
+    backend = router.make_router(args.backend, **backend_kwargs)
+
+    corpus = load_corpus(args.prompts, agents)[:args.limit]
+    labels = load_labels(args.labels, args.labels_backend) if args.labels else None
+    print(f"Benchmarking {backend.backend_id} on {len(corpus)} prompts (concurrency {args.concurrency}, batch size {args.batch_size})...")
+    results = run_benchmark(backend, corpus, concurrency=args.concurrency, duration_s=args.duration,
+                            batch_size=args.batch_size, warmup=args.warmup, labels=labels)
+    backend.close()
+
+    commit = git_commit()
+    report = {
+        "backend": args.backend,
+        "backend_id": backend.backend_id,
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        **results,
+    }
+    if telemetry.enabled():
+        report["spans"] = telemetry.span_summary()
+        telemetry.flush()
+    if args.compare:
+        with open(args.compare, "r") as f:
+            report["comparison"] = compare(report, json.load(f))
+
+    output = args.output or os.path.join("benchmarks", f"{args.backend}-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(json.dumps({key: report[key] for key in ("requests", "errors", "prompts_per_sec", "latency_ms", "ttft_ms", "tokens", "gpu_memory", "accuracy")}, indent=4))
+    if report.get("comparison"):
+        for name, change in report["comparison"].items():
+            flag = "REGRESSED" if change["regressed"] else "ok"
+            print(f"{name}: {change['baseline']:.4g} -> {change['current']:.4g} ({change['change_pct']:+.1f}%) {flag}")
+    print(f"Report saved to {output}")
@@ -0,0 +1,300 @@
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+SHARD_NAME = "shard-{:06d}.jsonl"
+
+def iter_inputs(path: str, prompt_field: str = "prompt", id_field: str = None):
+    """
+    Streams `(key, prompt)` from a JSONL file (objects or bare strings) or a CSV file with a header row.
+    The key is the `id_field` value, or the record's 0-based position in the input.
+    """
+    with open(path, "r", newline="") as f:
+        rows = csv.DictReader(f) if path.endswith(".csv") else (json.loads(line) for line in f if line.strip())
+        for index, row in enumerate(rows):
+            if isinstance(row, str):
+                yield index, row
+            else:
+                yield (row[id_field] if id_field else index), row[prompt_field]
+
+def iter_shards(records, shard_size: int):
+    """Groups the record stream into `(shard_index, records)` of `shard_size` records each."""
+    shard, index = [], 0
+    for record in records:
+        shard.append(record)
+        if len(shard) == shard_size:
+            yield index, shard
+            shard, index = [], index + 1
+    if shard:
+        yield index, shard
+
+def detect_gpus() -> list:
+    """Indices of the visible NVIDIA GPUs (from nvidia-smi, so torch is never imported here), or [] without any."""
+    if not shutil.which("nvidia-smi"):
+        return []
+    try:
+        output = subprocess.run(["nvidia-smi", "--query-gpu=index", "--format=csv,noheader"],
+                                capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+def build_router(backend: str, backend_kwargs: dict, api_base: str = None):
+    # Imported here so a worker can pick its GPU before any backend imports torch
+    import openai
+    import router
+    if api_base:
+        openai.api_base = api_base
+        openai.api_key = openai.api_key or os.getenv("OPENAI_API_KEY") or "stub"
+    return router.make_router(backend, **backend_kwargs)
+
+def route_shard(shard_router, shard: list, batch_size: int, retries: int = 3, retry_delay: float = 1.0) -> tuple:
+    """
+    Routes one shard `batch_size` prompts per `route_many` call; returns one output record per input record and
+    the number of failed routing calls. Prompts whose result carries an "error" are routed again, backing off
+    exponentially, up to `retries` times; if any still fail, the shard fails so it is rerun on resume.
+    """
+    records, errors = [], 0
+    for start in range(0, len(shard), batch_size):
+        batch = shard[start:start + batch_size]
+        results = shard_router.route_many([prompt for _, prompt in batch])
+        for attempt in range(retries + 1):
+            failed = [i for i, result in enumerate(results) if result.get("error")]
+            errors += len(failed)
+            if not failed:
+                break
+            if attempt == retries:
+                raise RuntimeError(f"{len(failed)} prompt(s) still failed after {retries} retries, e.g. {results[failed[0]]['error']}")
+            time.sleep(retry_delay * 2 ** attempt)
+            for i, result in zip(failed, shard_router.route_many([batch[i][1] for i in failed])):
+                results[i] = result
+        records += [{"id": key, "prompt": prompt, **result} for (key, prompt), result in zip(batch, results)]
+    return records, errors
+
+def write_shard(path: str, records: list) -> None:
+    # Written under a temporary name and renamed, so a shard file exists only once it is complete
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, path)
+
+def process_shard(shard_router, index: int, shard: list, shard_dir: str, batch_size: int) -> dict:
+    """Routes and writes one shard; failures are reported in the result so the shard is retried on resume."""
+    start = time.perf_counter()
+    try:
+        records, errors = route_shard(shard_router, shard, batch_size)
+        write_shard(os.path.join(shard_dir, SHARD_NAME.format(index)), records)
+    except Exception as e:
+        return {"index": index, "prompts": len(shard), "error": f"{type(e).__name__}: {e}"}
+    return {
+        "index": index,
+        "prompts": len(shard),
+        "errors": errors,
+        "seconds": time.perf_counter() - start,
+    }
+
+# Per-process state for the worker pool, set once by `_init_worker`
+_router = None
+_settings = None
+
+def _init_worker(backend: str, backend_kwargs: dict, api_base: str, batch_size: int, shard_dir: str, slots, gpus: list) -> None:
+    global _router, _settings
+    slot = slots.get()
+    if gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpus[slot % len(gpus)]
+    _router = build_router(backend, backend_kwargs, api_base)
+    _settings = {"batch_size": batch_size, "shard_dir": shard_dir}
+
+def _process_shard(index: int, shard: list) -> dict:
+    return process_shard(_router, index, shard, _settings["shard_dir"], _settings["batch_size"])
+
+class OutputWriter:
+    """
+    Assembles the output file from finished shard files as they complete: in input order (`ordered`, each shard
+    once all earlier ones are written) or in completion order with every record carrying its key.
+    """
+
+    def __init__(self, path: str, shard_dir: str, ordered: bool = True):
+        self.path = path
+        self.shard_dir = shard_dir
+        self.ordered = ordered
+        self.next_index = 0
+        self.ready = set()
+        self.file = open(path, "w")
+
+    def add(self, index: int) -> None:
+        self.ready.add(index)
+        if not self.ordered:
+            self._copy(index)
+            return
+        while self.next_index in self.ready:
+            self._copy(self.next_index)
+            self.next_index += 1
+
+    def _copy(self, index: int) -> None:
+        with open(os.path.join(self.shard_dir, SHARD_NAME.format(index)), "r") as shard:
+            shutil.copyfileobj(shard, self.file)
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+def job_manifest(input_path: str, backend: str, backend_kwargs: dict, shard_size: int, prompt_field: str, id_field: str) -> dict:
+    """What a resumed job must share with the run that wrote the existing shards."""
+    return {
+        "input": os.path.abspath(input_path),
+        "input_bytes": os.path.getsize(input_path),
+        "backend": backend,
+        "backend_kwargs": hashlib.sha256(json.dumps(backend_kwargs, sort_keys=True, default=str).encode("utf-8")).hexdigest(),
+        "shard_size": shard_size,
+        "prompt_field": prompt_field,
+        "id_field": id_field,
+    }
+
+def run_bulk(input_path: str, output_path: str, backend: str, backend_kwargs: dict = None, api_base: str = None, workers: int = 1,
+             shard_size: int = 10000, batch_size: int = 64, gpus: list = None, ordered: bool = True,
+             prompt_field: str = "prompt", id_field: str = None) -> dict:
+    """
+    Routes every prompt in `input_path` with `backend` and writes one JSON record per prompt to `output_path`.
+    The input is streamed in shards of `shard_size`, routed `batch_size` at a time by `workers` processes (one GPU
+    each from `gpus`, round-robin); each finished shard is saved under `<output_path>.shards/`, so an interrupted
+    or partly failed job resumes from the shards it has not finished. Returns the job's counts.
+    """
+    backend_kwargs = backend_kwargs or {}
+    shard_dir = output_path + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest = job_manifest(input_path, backend, backend_kwargs, shard_size, prompt_field, id_field)
+    manifest_path = os.path.join(shard_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            if json.load(f) != manifest:
+                raise ValueError(f"{shard_dir} holds shards of a different job; remove it to start over")
+    else:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    counts = {"shards": 0, "resumed_shards": 0, "failed_shards": 0, "prompts": 0, "errors": 0}
+    writer = OutputWriter(output_path, shard_dir, ordered)
+    start = time.perf_counter()
+
+    def finish(result: dict) -> None:
+        counts["shards"] += 1
+        if "error" in result:
+            counts["failed_shards"] += 1
+            print(f"Shard {result['index']} failed and will be retried on resume: {result['error']}")
+            return
+        counts["prompts"] += result["prompts"]
+        counts["errors"] += result["errors"]
+        writer.add(result["index"])
+        print(f"Shard {result['index']}: {result['prompts']} prompts in {result['seconds']:.1f}s "
+              f"({counts['prompts'] / (time.perf_counter() - start):.1f} prompts/s overall)")
+
+    def pending_shards():
+        for index, shard in iter_shards(iter_inputs(input_path, prompt_field, id_field), shard_size):
+            if os.path.exists(os.path.join(shard_dir, SHARD_NAME.format(index))):
+                counts["shards"] += 1
+                counts["resumed_shards"] += 1
+                writer.add(index)
+            else:
+                yield index, shard
+
+    try:
+        if workers <= 1 and not gpus:
+            shard_router = build_router(backend, backend_kwargs, api_base)
+            try:
+                for index, shard in pending_shards():
+                    finish(process_shard(shard_router, index, shard, shard_dir, batch_size))
+            finally:
+                shard_router.close()
+        else:
+            workers = max(workers, 1)
+            context = multiprocessing.get_context("spawn")
+            slots = context.Queue()
+            for slot in range(workers):
+                slots.put(slot)
+            completed = queue.Queue()
+            # Bounds the shards read ahead of the workers, so memory does not grow with the input
+            in_flight = threading.BoundedSemaphore(2 * workers)
+
+            def done(result: dict) -> None:
+                completed.put(result)
+                in_flight.release()
+
+            with context.Pool(workers, initializer=_init_worker,
+                              initargs=(backend, backend_kwargs, api_base, batch_size, shard_dir, slots, gpus or [])) as pool:
+                submitted = 0
+                for index, shard in pending_shards():
+                    while not in_flight.acquire(timeout=0.1):
+                        while not completed.empty():
+                            finish(completed.get())
+                    pool.apply_async(_process_shard, (index, shard), callback=done, error_callback=lambda e, index=index, size=len(shard):
+                                     done({"index": index, "prompts": size, "error": f"{type(e).__name__}: {e}"}))
+                    submitted += 1
+                    while not completed.empty():
+                        finish(completed.get())
+                while counts["shards"] - counts["resumed_shards"] < submitted:
+                    finish(completed.get())
+    finally:
+        writer.close()
+
+    counts["seconds"] = time.perf_counter() - start
+    counts["prompts_per_sec"] = counts["prompts"] / counts["seconds"] if counts["seconds"] else 0.0
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Route a large JSONL/CSV corpus of prompts offline, sharded across worker processes, with resume.")
+    parser.add_argument("input", help="JSONL (objects or strings) or CSV file of prompts.")
+    parser.add_argument("--output", help="JSONL of routing results (default: <input>.routed.jsonl).")
+    parser.add_argument("--backend", default="finetuned", help="A router.py backend: openai, ollama, finetuned, distilled, cpu, fastpath.")
+    parser.add_argument("--model", help="Model name for the openai/ollama backends, or the GGUF export for cpu.")
+    parser.add_argument("--api-base", help="OpenAI-compatible endpoint for the openai backend.")
+    parser.add_argument("--host", help="Ollama host for the ollama backend.")
+    parser.add_argument("--adapters", nargs="+", metavar="NAME=PATH", help="LoRA adapters served over one base model by the finetuned backend.")
+    parser.add_argument("--adapter", help="Which of --adapters routes the prompts (it routes over its own catalog unless --catalog is given).")
+    parser.add_argument("--threads", type=int, help="CPU threads per worker for the cpu backend.")
+    parser.add_argument("--catalog", help="Agent catalog (default: agents.json, or the --adapter's own catalog).")
+    parser.add_argument("--prompt-field", default="prompt", help="Field (JSONL) or column (CSV) holding the prompt.")
+    parser.add_argument("--id-field", help="Field or column identifying each prompt in the output (default: its position).")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per GPU for local models, else 1).")
+    parser.add_argument("--gpus", help="Comma-separated GPU indices to spread workers over (default: all, for local models).")
+    parser.add_argument("--shard-size", type=int, default=10000, help="Prompts per shard: the unit of resume.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Prompts per route_many call.")
+    parser.add_argument("--keyed", action="store_true", help="Write shards as they finish instead of in input order (records carry their id).")
+    args = parser.parse_args()
+
+    backend_kwargs = {}
+    if args.adapter or args.adapters:
+        adapters = dict(adapter.split("=", 1) for adapter in args.adapters or [])
+        if args.adapter not in adapters:
+            parser.error("--adapter must name one of --adapters")
+        backend_kwargs["adapters"] = adapters
+    catalog_path = args.catalog or (None if args.adapter else "agents.json")
+    if catalog_path:
+        with open(catalog_path, "r") as f:
+            backend_kwargs["agents"] = json.load(f)
+    for option, keyword in (("model", "model"), ("host", "host"), ("adapter", "adapter"), ("threads", "n_threads")):
+        if getattr(args, option) is not None:
+            backend_kwargs[keyword] = getattr(args, option)
+    if args.gpus is not None:
+        gpus = [gpu for gpu in args.gpus.split(",") if gpu]
+    else:
+        gpus = detect_gpus() if args.backend in ("finetuned", "distilled") else []
+    workers = args.workers or max(len(gpus), 1)
+
+    output = args.output or os.path.splitext(args.input)[0] + ".routed.jsonl"
+    print(f"Routing {args.input} with {args.backend} on {workers} worker(s){' over GPUs ' + ','.join(gpus) if gpus else ''}...")
+    counts = run_bulk(args.input, output, args.backend, backend_kwargs, args.api_base, workers, args.shard_size, args.batch_size,
+                      gpus, not args.keyed, args.prompt_field, args.id_field)
+    print(json.dumps(counts, indent=4))
+    if counts["failed_shards"]:
+        print(f"{counts['failed_shards']} shard(s) failed; rerun the same command to resume them.")
+    print(f"Results saved to {output}")
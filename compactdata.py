@@ -0,0 +1,134 @@
+import argparse
+import hashlib
+import json
+import re
+
+# Instruction every example shares for a given catalog; only the agents block changes between catalogs
+INSTRUCTION_TEMPLATE = "You are an assistant that strictly outputs JSON-formatted responses.\n\nAgents:\n{agents_json}\n\nRespond with the following JSON structure:\n{{\n    \"recommended_agent\": \"<agent_name>\",\n    \"justification\": \"<reason for selecting the agent>\"\n}}"
+
+# Training rows wrap the prompt as `User Input: '...'`
+USER_INPUT = re.compile(r"^User Input: '(.*)'$", re.S)
+
+def unwrap_input(text: str) -> str:
+    """The raw prompt inside a training row's `User Input: '...'` wrapper."""
+    match = USER_INPUT.match(text)
+    return match.group(1) if match else text
+
+def short_catalog(agents: dict) -> str:
+    """One `- name: first clause of the description` line per agent, a fraction of the tokens of the JSON catalog."""
+    return "\n".join(f"- {name}: {description.split(',')[0].rstrip('.')}" for name, description in agents.items())
+
+def build_instruction(agents: dict, short: bool = False) -> str:
+    """Renders the training instruction for an agent catalog, optionally with the shortened catalog."""
+    return INSTRUCTION_TEMPLATE.format(agents_json=short_catalog(agents) if short else json.dumps(agents, indent=4))
+
+def catalog_id(agents: dict) -> str:
+    """Content hash of a catalog, in its original key order since that order shows up in the instruction."""
+    return hashlib.sha256(json.dumps(agents).encode("utf-8")).hexdigest()[:16]
+
+def default_justification(agent: str) -> str:
+    return f"The user query matches the functionality of the {agent.replace('_', ' ')}."
+
+def build_output(agent: str, justification: str) -> str:
+    """Renders the training response exactly as `json.dumps(..., indent=4)` did in alpaca_cleaned.json."""
+    return json.dumps({"recommended_agent": agent, "justification": justification}, indent=4)
+
+class CompactWriter:
+    """
+    Writes the compact JSONL format: each catalog once as a {"type": "catalog"} record, then one small
+    {"type": "example"} record per row that references its catalog by id.
+    """
+
+    def __init__(self, path: str, mode: str = "w"):
+        self.file = open(path, mode)
+        self.catalogs = set()
+
+    def add_catalog(self, agents: dict, instruction: str = None) -> str:
+        """Writes a catalog the first time it is seen and returns its id; `instruction` overrides the rendered one."""
+        cid = catalog_id(agents)
+        if cid not in self.catalogs:
+            record = {"type": "catalog", "id": cid, "agents": agents}
+            if instruction is not None and instruction != build_instruction(agents):
+                record["instruction"] = instruction
+            self.file.write(json.dumps(record) + "\n")
+            self.catalogs.add(cid)
+        return cid
+
+    def add_example(self, cid: str, user_input: str, agent: str, justification: str = None) -> None:
+        record = {"type": "example", "catalog": cid, "input": user_input, "agent": agent}
+        # The templated justification is the norm, so it is only stored when it differs
+        if justification is not None and justification != default_justification(agent):
+            record["justification"] = justification
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def iter_records(path: str):
+    """Streams the raw records of a compact file."""
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def load_catalogs(path: str) -> dict:
+    """Maps catalog id to {"agents", "instruction"} without materializing any example."""
+    catalogs = {}
+    for record in iter_records(path):
+        if record["type"] == "catalog":
+            catalogs[record["id"]] = {
+                "agents": record["agents"],
+                "instruction": record.get("instruction") or build_instruction(record["agents"]),
+            }
+    return catalogs
+
+def iter_examples(path: str, short: bool = False):
+    """
+    Lazily materializes alpaca-style {"instruction", "input", "output"} examples, one at a time.
+    With `short`, every catalog is rendered with `short_catalog` (ignoring stored instruction overrides).
+    """
+    catalogs = {}
+    for record in iter_records(path):
+        if record["type"] == "catalog":
+            if short:
+                catalogs[record["id"]] = build_instruction(record["agents"], short=True)
+            else:
+                catalogs[record["id"]] = record.get("instruction") or build_instruction(record["agents"])
+            continue
+        agent = record["agent"]
+        yield {
+            "instruction": catalogs[record["catalog"]],
+            "input": record["input"],
+            "output": build_output(agent, record.get("justification") or default_justification(agent)),
+        }
+
+def convert_alpaca(json_path: str, output_path: str) -> int:
+    """Converts an alpaca_cleaned.json-style file into the compact format and returns the number of examples."""
+    with open(json_path, "r") as f:
+        examples = json.load(f)
+    catalog_ids = {}
+    with CompactWriter(output_path) as writer:
+        for example in examples:
+            instruction = example["instruction"]
+            if instruction not in catalog_ids:
+                agents_json = instruction.split("Agents:\n", 1)[1].split("\n\nRespond with", 1)[0]
+                catalog_ids[instruction] = writer.add_catalog(json.loads(agents_json), instruction)
+            output = json.loads(example["output"])
+            writer.add_example(catalog_ids[instruction], example["input"], output["recommended_agent"], output["justification"])
+    return len(examples)
+
+if __name__ == "__main__":
+    # alpaca_compact.jsonl is the dataset of record; this converts older alpaca_cleaned.json-style files into it
+    parser = argparse.ArgumentParser(description="Convert an Alpaca-style JSON dataset into the compact format.")
+    parser.add_argument("input", help="An alpaca_cleaned.json-style file.")
+    parser.add_argument("--output", default="alpaca_compact.jsonl")
+    args = parser.parse_args()
+
+    count = convert_alpaca(args.input, args.output)
+    print(f"Converted {count} examples to {args.output}")
@@ -0,0 +1,207 @@
+import json
+import typing
+import torch
+import transformers
+from pydantic import Field, create_model
+from original import AgentResponse
+
+class AgentTrie:
+    """Prefix tree over token id sequences, e.g. each agent name (plus its closing quote) after the response head."""
+
+    def __init__(self, sequences: dict):
+        self.sequences = sequences
+        self.root = {}
+        for agent, token_ids in sequences.items():
+            node = self.root
+            for token_id in token_ids:
+                node = node.setdefault(token_id, {})
+            node[None] = agent
+
+    def next_tokens(self, prefix: list) -> list:
+        """Returns the token ids that may follow `prefix`, or an empty list once an agent is complete."""
+        node = self.root
+        for token_id in prefix:
+            node = node.get(token_id)
+            if node is None:
+                return []
+        return [token_id for token_id in node if token_id is not None]
+
+    def match(self, prefix: list):
+        """Returns the agent spelled by `prefix`, or None if it is not a complete name."""
+        node = self.root
+        for token_id in prefix:
+            node = node.get(token_id)
+            if node is None:
+                return None
+        return node.get(None)
+
+# `AgentResponse` variants per catalog, keyed by the tuple of agent names
+_response_models = {}
+
+def agent_response_model(agent_names: list):
+    """`AgentResponse` with `recommended_agent` limited to `agent_names`, e.g. the catalog a router was trained on."""
+    key = tuple(agent_names)
+    if key not in _response_models:
+        _response_models[key] = create_model(
+            "AgentResponse",
+            __base__=AgentResponse,
+            recommended_agent=(typing.Optional[typing.Literal[key]], Field(None, description="Recommended agent, or null if none selected.")),
+        )
+    return _response_models[key]
+
+def response_segments(response_model=AgentResponse) -> list:
+    """
+    Lays out the `json.dumps(..., indent=4)` rendering of `response_model` as decoding segments.
+    Literal fields become ("choice", [texts]) with the surrounding JSON folded in; str fields become ("string", None).
+    """
+    segments = []
+    pending = ["{\n"]
+    hints = typing.get_type_hints(response_model)
+    for index, (name, hint) in enumerate(hints.items()):
+        separator = ",\n" if index < len(hints) - 1 else "\n"
+        key = f'    {json.dumps(name)}: '
+        if hint is str:
+            segments.append(("choice", [text + key + '"' for text in pending]))
+            segments.append(("string", None))
+            pending = ['"' + separator]
+            continue
+
+        values = []
+        for arg in typing.get_args(hint) or (hint,):
+            if arg is type(None):
+                values.append(None)
+            else:
+                values.extend(typing.get_args(arg))
+        if not values:
+            raise TypeError(f"Field '{name}' must be a str or a Literal for constrained decoding.")
+        pending = [text + key + json.dumps(value) + separator for text in pending for value in values]
+
+    segments.append(("choice", [text + "}" for text in pending]))
+    return segments
+
+# Per-tokenizer mask of tokens that can appear inside a JSON string without escaping
+_string_token_masks = {}
+
+def _string_token_mask(tokenizer) -> torch.Tensor:
+    """Marks the vocabulary entries that contain no quote, backslash or control character."""
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in _string_token_masks:
+        special_ids = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}))
+        mask = torch.zeros(len(tokenizer), dtype=torch.bool)
+        for token_id in range(len(tokenizer)):
+            if token_id in special_ids:
+                continue
+            text = tokenizer.decode([token_id])
+            mask[token_id] = bool(text) and not any(char in '"\\' or ord(char) < 0x20 for char in text)
+        _string_token_masks[key] = mask
+    return _string_token_masks[key]
+
+class AgentResponseLogitsProcessor(transformers.LogitsProcessor):
+    """
+    Masks every token that would leave the `AgentResponse` JSON layout: the agent is forced from the closed set,
+    the justification is capped at `max_justification_tokens`, and EOS is forced once the closing brace is out.
+    """
+
+    def __init__(self, tokenizer, response_model=AgentResponse, max_justification_tokens: int = 64):
+        self.max_justification_tokens = max_justification_tokens
+        self.eos_token_id = tokenizer.eos_token_id
+        self.segments = []
+        for kind, texts in response_segments(response_model):
+            if kind == "choice":
+                sequences = {text: tokenizer(text, add_special_tokens=False).input_ids for text in texts}
+                self.segments.append((kind, AgentTrie(sequences)))
+            else:
+                self.segments.append((kind, None))
+        self.string_mask = _string_token_mask(tokenizer)
+        self._device_masks = {}
+        self.prompt_length = None
+        self.states = []
+
+    @property
+    def max_new_tokens(self) -> int:
+        """Upper bound on the tokens a constrained response can take, including the final EOS."""
+        total = 1
+        for kind, trie in self.segments:
+            if kind == "choice":
+                total += max(len(token_ids) for token_ids in trie.sequences.values())
+            else:
+                total += self.max_justification_tokens
+        return total
+
+    def _advance(self, state: dict, token_id: int) -> None:
+        """Moves one row's decoding state past `token_id`."""
+        if state["segment"] >= len(self.segments):
+            return
+        kind, trie = self.segments[state["segment"]]
+        if kind == "string":
+            if token_id < len(self.string_mask) and self.string_mask[token_id]:
+                state["count"] += 1
+                return
+            # Any other token opens the segment that closes the string
+            state.update(segment=state["segment"] + 1, tokens=[], count=0)
+            kind, trie = self.segments[state["segment"]]
+        state["tokens"].append(token_id)
+        if not trie.next_tokens(state["tokens"]):
+            state.update(segment=state["segment"] + 1, tokens=[], count=0)
+
+    def sync(self, input_ids: torch.Tensor) -> None:
+        """Catches the per-row states up with the tokens generated so far."""
+        if self.prompt_length is None or len(self.states) != input_ids.shape[0]:
+            self.prompt_length = input_ids.shape[1]
+            self.states = [{"segment": 0, "tokens": [], "count": 0, "seen": 0} for _ in range(input_ids.shape[0])]
+        generated = input_ids[:, self.prompt_length:].tolist()
+        for state, token_ids in zip(self.states, generated):
+            for token_id in token_ids[state["seen"]:]:
+                self._advance(state, token_id)
+            state["seen"] = len(token_ids)
+
+    def done(self) -> list:
+        """Returns, per row, whether the closing brace has been emitted."""
+        return [state["segment"] >= len(self.segments) for state in self.states]
+
+    def _allowed(self, state: dict, vocab_size: int, device) -> torch.Tensor:
+        """Builds the boolean mask of tokens allowed next for one row."""
+        allowed = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        if state["segment"] >= len(self.segments):
+            allowed[self.eos_token_id] = True
+            return allowed
+        kind, trie = self.segments[state["segment"]]
+        if kind == "choice":
+            allowed[trie.next_tokens(state["tokens"])] = True
+            return allowed
+
+        if state["count"] < self.max_justification_tokens:
+            if device not in self._device_masks:
+                self._device_masks[device] = self.string_mask.to(device)
+            size = min(vocab_size, len(self.string_mask))
+            allowed[:size] = self._device_masks[device][:size]
+        # The string can always be closed by starting the segment that follows it
+        _, closing = self.segments[state["segment"] + 1]
+        allowed[closing.next_tokens([])] = True
+        return allowed
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.sync(input_ids)
+        for row, state in enumerate(self.states):
+            allowed = self._allowed(state, scores.shape[-1], scores.device)
+            scores[row] = scores[row].masked_fill(~allowed, float("-inf"))
+        return scores
+
+class AgentResponseStoppingCriteria(transformers.StoppingCriteria):
+    """Stops each row as soon as its constrained response is complete, without waiting for EOS."""
+
+    def __init__(self, processor: AgentResponseLogitsProcessor):
+        self.processor = processor
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        self.processor.sync(input_ids)
+        return torch.tensor(self.processor.done(), dtype=torch.bool, device=input_ids.device)
+
+def constrained_generation_kwargs(tokenizer, response_model=AgentResponse, max_justification_tokens: int = 64) -> dict:
+    """Returns the `generate()` arguments that decode a schema-valid response and stop at its closing brace."""
+    processor = AgentResponseLogitsProcessor(tokenizer, response_model, max_justification_tokens)
+    return {
+        "logits_processor": transformers.LogitsProcessorList([processor]),
+        "stopping_criteria": transformers.StoppingCriteriaList([AgentResponseStoppingCriteria(processor)]),
+        "max_new_tokens": processor.max_new_tokens,
+    }
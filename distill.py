@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import random
+import threading
+
+import torch
+import transformers
+
+import compactdata
+
+# Small sentence encoder the classifier head sits on; runs comfortably on CPU
+ENCODER_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Where the trained head and its config are saved by default
+DISTILLED_PATH = "superagent/distilled_router"
+
+class DistilledRouter:
+    """
+    Closed-set router: a frozen sentence encoder (mean-pooled hidden states) and a linear head over the agents,
+    so one encoder forward pass scores every agent. Loaded on first use, on CPU unless `device` says otherwise.
+    """
+
+    def __init__(self, path: str = DISTILLED_PATH, device: str = "cpu", num_threads: int = None, max_length: int = 128):
+        self.path = path
+        self.device = device
+        self.num_threads = num_threads
+        self.max_length = max_length
+        self._encoder = None
+        self._tokenizer = None
+        self._head = None
+        self._agents = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        with self._lock:
+            if self._head is not None:
+                return
+            if self.num_threads:
+                torch.set_num_threads(self.num_threads)
+            with open(os.path.join(self.path, "config.json"), "r") as f:
+                config = json.load(f)
+            self._tokenizer = transformers.AutoTokenizer.from_pretrained(config["encoder"])
+            self._encoder = transformers.AutoModel.from_pretrained(config["encoder"]).to(self.device).eval()
+            head = torch.nn.Linear(config["hidden_size"], len(config["agents"]))
+            head.load_state_dict(torch.load(os.path.join(self.path, "head.pt"), map_location="cpu"))
+            self._head = head.to(self.device).eval()
+            self._agents = config["agents"]
+
+    @property
+    def agents(self) -> list:
+        self.load()
+        return self._agents
+
+    def embed(self, texts: list, batch_size: int = 64) -> torch.Tensor:
+        """Mean-pooled, L2-normalized encoder embeddings of `texts`."""
+        self.load()
+        return embed_texts(self._encoder, self._tokenizer, texts, self.device, self.max_length, batch_size)
+
+    def classify_agents(self, texts: list, top_k: int = None, batch_size: int = 64) -> list:
+        """Same result shape as `FinetunedRouter.classify_agents`: the recommended agent and the top-k ranking."""
+        embeddings = self.embed(texts, batch_size)
+        with torch.no_grad():
+            probabilities = torch.softmax(self._head(embeddings), dim=-1).cpu()
+        results = []
+        for row in probabilities:
+            values, indices = row.topk(top_k or len(self.agents))
+            ranking = [{"agent": self.agents[i], "probability": float(p)} for p, i in zip(values.tolist(), indices.tolist())]
+            results.append({"recommended_agent": ranking[0]["agent"], "ranking": ranking})
+        return results
+
+    def classify_agent(self, text: str, top_k: int = None) -> dict:
+        return self.classify_agents([text], top_k=top_k)[0]
+
+def embed_texts(encoder, tokenizer, texts: list, device: str, max_length: int = 128, batch_size: int = 64) -> torch.Tensor:
+    embeddings = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            inputs = tokenizer(texts[start:start + batch_size], padding=True, truncation=True, max_length=max_length, return_tensors="pt").to(device)
+            hidden = encoder(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            embeddings.append(torch.nn.functional.normalize(pooled, dim=-1))
+    return torch.cat(embeddings)
+
+def load_data_labels(data_path: str, agents: list) -> tuple:
+    """Prompts and one-hot targets from the compact training data."""
+    texts, targets = [], []
+    for record in compactdata.iter_records(data_path):
+        if record["type"] == "example" and record["agent"] in agents:
+            texts.append(compactdata.unwrap_input(record["input"]))
+            targets.append({record["agent"]: 1.0})
+    return texts, targets
+
+def load_checkpoint_labels(checkpoint_path: str, agents: list, backend: str = "openai") -> tuple:
+    """Prompts and one-hot targets from one backend's answers in an `evaluate.py` checkpoint (e.g. GPT-4 labels)."""
+    labels = {}
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record["backend"] == backend and record.get("recommended_agent") in agents:
+                labels[record["prompt"]] = record["recommended_agent"]
+    return list(labels), [{agent: 1.0} for agent in labels.values()]
+
+def load_prompts(path: str) -> list:
+    """Reads a JSON list or JSONL file of prompts (strings or objects with a "prompt" field)."""
+    with open(path, "r") as f:
+        items = [json.loads(line) for line in f if line.strip()] if path.endswith(".jsonl") else json.load(f)
+    return [item["prompt"] if isinstance(item, dict) else item for item in items]
+
+def load_teacher_labels(texts: list, agents: list, batch_size: int = 16) -> tuple:
+    """Soft targets: the fine-tuned model's full probability distribution over the agents for each prompt."""
+    import inference
+    rankings = inference.get_router().score_agents_batch(texts, agent_names=agents, batch_size=batch_size)
+    return texts, [{entry["agent"]: entry["probability"] for entry in ranking} for ranking in rankings]
+
+def train_classifier(texts: list, targets: list, agents: list, output_path: str = DISTILLED_PATH, encoder_name: str = ENCODER_NAME,
+                     epochs: int = 100, learning_rate: float = 1e-2, weight_decay: float = 1e-4, batch_size: int = 256,
+                     validation_fraction: float = 0.1, device: str = None, seed: int = 0) -> dict:
+    """
+    Trains the linear head on frozen encoder embeddings against `targets` (dicts of agent -> probability) with
+    soft cross-entropy, and saves it with its config to `output_path`. Returns the training metrics.
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(seed)
+    tokenizer = transformers.AutoTokenizer.from_pretrained(encoder_name)
+    encoder = transformers.AutoModel.from_pretrained(encoder_name).to(device).eval()
+    # The encoder is frozen, so every prompt is embedded exactly once
+    embeddings = embed_texts(encoder, tokenizer, texts, device)
+    index = {agent: i for i, agent in enumerate(agents)}
+    target_matrix = torch.zeros(len(texts), len(agents), device=device)
+    for row, target in enumerate(targets):
+        for agent, probability in target.items():
+            target_matrix[row, index[agent]] = probability
+    target_matrix = target_matrix / target_matrix.sum(dim=-1, keepdim=True).clamp(min=1e-9)
+
+    order = list(range(len(texts)))
+    random.Random(seed).shuffle(order)
+    held_out = max(1, int(len(order) * validation_fraction)) if validation_fraction and len(order) > 1 else 0
+    validation, training = order[:held_out], order[held_out:]
+
+    head = torch.nn.Linear(embeddings.shape[-1], len(agents)).to(device)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    for epoch in range(epochs):
+        random.Random(seed + epoch).shuffle(training)
+        for start in range(0, len(training), batch_size):
+            batch = torch.tensor(training[start:start + batch_size], device=device)
+            log_probabilities = torch.log_softmax(head(embeddings[batch]), dim=-1)
+            loss = -(target_matrix[batch] * log_probabilities).sum(dim=-1).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+    metrics = {"examples": len(training), "held_out": len(validation), "final_loss": float(loss)}
+    if validation:
+        with torch.no_grad():
+            batch = torch.tensor(validation, device=device)
+            predicted = head(embeddings[batch]).argmax(dim=-1)
+            metrics["held_out_accuracy"] = float((predicted == target_matrix[batch].argmax(dim=-1)).float().mean())
+
+    os.makedirs(output_path, exist_ok=True)
+    torch.save({key: value.cpu() for key, value in head.state_dict().items()}, os.path.join(output_path, "head.pt"))
+    with open(os.path.join(output_path, "config.json"), "w") as f:
+        json.dump({"encoder": encoder_name, "hidden_size": embeddings.shape[-1], "agents": agents, "metrics": metrics}, f, indent=4)
+    return metrics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill routing decisions into a small encoder + linear-head classifier.")
+    parser.add_argument("--labels", choices=["data", "finetuned", "openai"], default="finetuned",
+                        help="data: training-set labels; finetuned: the fine-tuned model's soft scores; openai: GPT-4 answers from an evaluate.py checkpoint.")
+    parser.add_argument("--data", default="alpaca_compact.jsonl")
+    parser.add_argument("--prompts", help="Extra unlabeled prompts (JSON or JSONL) for the fine-tuned teacher to label.")
+    parser.add_argument("--checkpoint", default="eval_checkpoint.jsonl")
+    parser.add_argument("--catalog", default="agents.json")
+    parser.add_argument("--encoder", default=ENCODER_NAME)
+    parser.add_argument("--output", default=DISTILLED_PATH)
+    parser.add_argument("--epochs", type=int, default=100)
+    args = parser.parse_args()
+
+    with open(args.catalog, "r") as f:
+        agents = list(json.load(f))
+
+    if args.labels == "openai":
+        texts, targets = load_checkpoint_labels(args.checkpoint, agents)
+    else:
+        texts, targets = load_data_labels(args.data, agents)
+        if args.labels == "finetuned":
+            if args.prompts:
+                texts += load_prompts(args.prompts)
+            texts, targets = load_teacher_labels(texts, agents)
+
+    print(f"Training on {len(texts)} labelled prompts over {len(agents)} agents...")
+    metrics = train_classifier(texts, targets, agents, args.output, args.encoder, epochs=args.epochs)
+    print(json.dumps(metrics, indent=4))
+    print(f"Distilled router saved to {args.output}")
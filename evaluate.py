@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import combinations
+
+import openai
+import pandas as pd
+from dotenv import load_dotenv
+
+import test
+from retries import is_retryable, retry_delay
+
+# Remote backends fan out over a thread pool; the local model is batched
+REMOTE_BACKENDS = {
+    "openai": test.recommend_agent_openai,
+    "ollama": test.recommend_agent_ollama,
+}
+LOCAL_BACKENDS = {
+    "finetuned": test.recommend_agents_finetuned,
+    "distilled": test.recommend_agents_distilled,
+    "cpu": test.recommend_agents_cpu,
+}
+COLUMNS = {
+    "openai": "GPT Response",
+    "ollama": "Ollama Response",
+    "finetuned": "Fine-tuned Response",
+    "distilled": "Distilled Response",
+    "cpu": "CPU Response",
+}
+
+def call_with_retries(func, prompt: str, max_retries: int = 5, base_delay: float = 1.0) -> dict:
+    """Calls a `prompt -> dict` backend, retrying transient failures; other errors are recorded in the result."""
+    for attempt in range(max_retries + 1):
+        try:
+            return {"recommended_agent": func(prompt).get("recommended_agent"), "error": None}
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                return {"recommended_agent": None, "error": f"{type(e).__name__}: {e}"}
+            time.sleep(retry_delay(e, attempt, base_delay))
+
+class Checkpoint:
+    """Append-only JSONL log of per-prompt, per-backend results, so an interrupted run resumes where it stopped."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.results = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A run killed mid-write can leave a truncated last line
+                        continue
+                    self.results[(record["index"], record["backend"])] = record
+
+    def done(self, index: int, prompt: str, backend: str) -> bool:
+        """Whether `prompt` at `index` already has an error-free result (a changed prompt list invalidates it)."""
+        record = self.results.get((index, backend))
+        return record is not None and record["prompt"] == prompt and record["error"] is None
+
+    def write(self, record: dict) -> None:
+        with self._lock:
+            self.results[(record["index"], record["backend"])] = record
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+def agreement_metrics(rows: list, backends: list, reference: str) -> dict:
+    """Pairwise agreement on `recommended_agent`, each backend's agreement with the reference, and error counts."""
+    def agreement_pct(a: str, b: str) -> float:
+        matches = sum(row[a] is not None and row[a] == row[b] for row in rows)
+        return 100 * matches / len(rows) if rows else 0.0
+
+    metrics = {
+        "prompts": len(rows),
+        "pairwise_agreement_pct": {f"{a}~{b}": agreement_pct(a, b) for a, b in combinations(backends, 2)},
+        "errors": {backend: sum(row[f"{backend}_error"] is not None for row in rows) for backend in backends},
+    }
+    if reference in backends:
+        metrics["reference"] = reference
+        metrics["agreement_with_reference_pct"] = {
+            backend: agreement_pct(reference, backend) for backend in backends if backend != reference
+        }
+    return metrics
+
+def run_evaluation(prompts: list, backends: list, checkpoint_path: str = "eval_checkpoint.jsonl", csv_path: str = "results.csv",
+                   metrics_path: str = "eval_metrics.json", concurrency: int = 8, local_batch_size: int = 16,
+                   max_retries: int = 5, reference: str = "openai") -> dict:
+    """Routes every prompt through every backend, resuming from `checkpoint_path`, and writes the CSV and metrics."""
+    checkpoint = Checkpoint(checkpoint_path)
+
+    def record(index: int, backend: str, result: dict) -> None:
+        checkpoint.write({"index": index, "prompt": prompts[index], "backend": backend, **result})
+
+    remote = [backend for backend in backends if backend in REMOTE_BACKENDS]
+    local = [backend for backend in backends if backend in LOCAL_BACKENDS]
+    pending_remote = [(i, backend) for backend in remote for i in range(len(prompts)) if not checkpoint.done(i, prompts[i], backend)]
+    print(f"Evaluating {len(prompts)} prompts on {', '.join(backends)} ({len(pending_remote)} remote calls pending)")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(call_with_retries, REMOTE_BACKENDS[backend], prompts[i], max_retries): (i, backend)
+            for i, backend in pending_remote
+        }
+
+        # The local model runs in batches on this thread while the remote calls are in flight
+        for backend in local:
+            pending = [i for i in range(len(prompts)) if not checkpoint.done(i, prompts[i], backend)]
+            for start in range(0, len(pending), local_batch_size):
+                batch = pending[start:start + local_batch_size]
+                try:
+                    results = [{"recommended_agent": r.get("recommended_agent"), "error": r.get("error")}
+                               for r in LOCAL_BACKENDS[backend]([prompts[i] for i in batch])]
+                except Exception as e:
+                    results = [{"recommended_agent": None, "error": f"{type(e).__name__}: {e}"}] * len(batch)
+                for i, result in zip(batch, results):
+                    record(i, backend, result)
+                print(f"{backend}: {min(start + local_batch_size, len(pending))}/{len(pending)}")
+
+        for completed, future in enumerate(as_completed(futures), start=1):
+            i, backend = futures[future]
+            record(i, backend, future.result())
+            if completed % 10 == 0 or completed == len(futures):
+                print(f"remote: {completed}/{len(futures)}")
+
+    rows = []
+    for i, prompt in enumerate(prompts):
+        row = {"Prompt": prompt}
+        for backend in backends:
+            result = checkpoint.results.get((i, backend), {"recommended_agent": None, "error": "missing"})
+            row[backend] = result["recommended_agent"]
+            row[f"{backend}_error"] = result["error"]
+        rows.append(row)
+
+    metrics = agreement_metrics(rows, backends, reference)
+    pd.DataFrame([
+        {"Prompt": row["Prompt"], **{COLUMNS[backend]: row[backend] for backend in backends}} for row in rows
+    ]).to_csv(csv_path, index=False)
+    with open(metrics_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+    print(f"Results saved to {csv_path}, metrics to {metrics_path}")
+    return metrics
+
+def load_prompts(path: str = None) -> list:
+    """Reads prompts from a JSON list or JSONL file (strings or objects with a "prompt" field), or uses the built-in 50."""
+    if path is None:
+        return test.generate_user_inputs()
+    with open(path, "r") as f:
+        if path.endswith(".jsonl"):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = json.load(f)
+    return [item["prompt"] if isinstance(item, dict) else item for item in items]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare router backends on a prompt set, resumably.")
+    parser.add_argument("--prompts", help="JSON or JSONL prompt file (defaults to test.generate_user_inputs()).")
+    parser.add_argument("--backends", default="openai,ollama,finetuned")
+    parser.add_argument("--reference", default="openai")
+    parser.add_argument("--checkpoint", default="eval_checkpoint.jsonl")
+    parser.add_argument("--csv", default="results.csv")
+    parser.add_argument("--metrics", default="eval_metrics.json")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--local-batch-size", type=int, default=16)
+    parser.add_argument("--max-retries", type=int, default=5)
+    args = parser.parse_args()
+
+    load_dotenv()
+    if os.getenv("OPENAI_API_KEY"):
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    metrics = run_evaluation(
+        load_prompts(args.prompts),
+        [backend.strip() for backend in args.backends.split(",")],
+        checkpoint_path=args.checkpoint,
+        csv_path=args.csv,
+        metrics_path=args.metrics,
+        concurrency=args.concurrency,
+        local_batch_size=args.local_batch_size,
+        max_retries=args.max_retries,
+        reference=args.reference,
+    )
+    print(json.dumps(metrics, indent=4))
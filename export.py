@@ -0,0 +1,60 @@
+import argparse
+import glob
+import json
+import os
+
+# Where the CPU export of the fine-tuned router goes by default
+GGUF_PATH = "superagent/1B_finetuned_llama3.2-gguf"
+# llama.cpp quantization methods by the names we use for them
+QUANTIZATIONS = {"int8": "q8_0", "int4": "q4_k_m", "f16": "f16"}
+
+def export_gguf(model_name: str = "superagent/1B_finetuned_llama3.2", output_path: str = GGUF_PATH, quantization: str = "int8",
+                catalog_path: str = "agents.json", max_seq_length: int = 5020) -> str:
+    """
+    Merges the LoRA adapter into the 16-bit base weights and writes a quantized GGUF file for llama.cpp, plus an
+    `export.json` recording the file, its quantization and the agent catalog it was trained on. Needs the GPU
+    training environment; the export itself runs anywhere llama.cpp does. Returns the GGUF path.
+    """
+    import unsloth
+
+    method = QUANTIZATIONS.get(quantization, quantization)
+    # Loaded unquantized, so the adapter is merged into the original weights rather than a 4-bit approximation
+    model, tokenizer = unsloth.FastLanguageModel.from_pretrained(
+        model_name=model_name,
+        max_seq_length=max_seq_length,
+        dtype=None,
+        load_in_4bit=False
+    )
+    before = set(glob.glob(os.path.join(output_path, "*.gguf")))
+    model.save_pretrained_gguf(output_path, tokenizer, quantization_method=method)
+    # The file name depends on the unsloth version; take the newest file for this quantization
+    written = sorted(set(glob.glob(os.path.join(output_path, "*.gguf"))) - before or before, key=os.path.getmtime)
+    if not written:
+        raise FileNotFoundError(f"No GGUF file was written to {output_path}")
+    matching = [path for path in written if method.lower() in os.path.basename(path).lower()]
+    gguf_path = (matching or written)[-1]
+
+    with open(catalog_path, "r") as f:
+        agents = json.load(f)
+    with open(os.path.join(output_path, "export.json"), "w") as f:
+        json.dump({"gguf": os.path.basename(gguf_path), "quantization": method, "source": model_name, "agents": agents}, f, indent=4)
+    return gguf_path
+
+def load_export(path: str = GGUF_PATH) -> tuple:
+    """Resolves an export directory (or a bare .gguf file) to `(gguf_path, agents)`; agents is None for a bare file."""
+    if os.path.isfile(path):
+        return path, None
+    with open(os.path.join(path, "export.json"), "r") as f:
+        meta = json.load(f)
+    return os.path.join(path, meta["gguf"]), meta["agents"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the fine-tuned router as a quantized GGUF file for CPU inference with llama.cpp.")
+    parser.add_argument("--model", default="superagent/1B_finetuned_llama3.2", help="The fine-tuned checkpoint written by finetune.py.")
+    parser.add_argument("--output", default=GGUF_PATH)
+    parser.add_argument("--quantization", default="int8", help="int8 (q8_0), int4 (q4_k_m), f16, or any llama.cpp quantization method.")
+    parser.add_argument("--catalog", default="agents.json")
+    args = parser.parse_args()
+
+    gguf_path = export_gguf(args.model, args.output, args.quantization, args.catalog)
+    print(f"GGUF export saved to {gguf_path}")
@@ -0,0 +1,134 @@
+import re
+import zlib
+import numpy as np
+import ollama
+
+# Lowercase word tokens; everything else separates them
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+class HashingEmbedder:
+    """
+    Dependency-free TF-IDF embedder over hashed word, word-bigram and character 4-gram features.
+    Character n-grams let "gardening" still match "garden" without a stemmer.
+    """
+
+    def __init__(self, dim: int = 8192):
+        self.dim = dim
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def _features(self, text: str) -> list:
+        words = WORD_PATTERN.findall(text.lower().replace("_", " "))
+        features = list(words)
+        features += [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features += [f"#c{padded[i:i + 4]}" for i in range(max(1, len(padded) - 3))]
+        return features
+
+    def _counts(self, texts: list) -> np.ndarray:
+        counts = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                # crc32 rather than hash() so vectors stay stable across processes
+                counts[row, zlib.crc32(feature.encode("utf-8")) % self.dim] += 1
+        return counts
+
+    def fit(self, texts: list) -> None:
+        """Computes smoothed inverse document frequencies over the agent descriptions."""
+        document_frequency = (self._counts(texts) > 0).sum(axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+    def __call__(self, texts: list) -> np.ndarray:
+        return np.log1p(self._counts(texts)) * self.idf
+
+class OllamaEmbedder:
+    """Embeds texts with an embedding model served by Ollama; more accurate, but a network round trip per prompt."""
+
+    def __init__(self, model: str = "nomic-embed-text"):
+        self.model = model
+
+    def fit(self, texts: list) -> None:
+        pass
+
+    def __call__(self, texts: list) -> np.ndarray:
+        response = ollama.embed(model=self.model, input=texts)
+        return np.asarray(response["embeddings"], dtype=np.float32)
+
+class AgentIndex:
+    """Unit-normalized embedding matrix of the agent catalog, searched with one matrix-vector product."""
+
+    def __init__(self, agents: dict, embedder=None):
+        self.agents = agents
+        self.names = list(agents)
+        self.embedder = embedder or HashingEmbedder()
+        documents = [f"{name.replace('_', ' ')}: {description}" for name, description in agents.items()]
+        self.embedder.fit(documents)
+        self.matrix = self._normalize(self.embedder(documents))
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def search(self, prompt: str, k: int = 5) -> list:
+        """Returns the `k` most similar agents as (name, cosine similarity) pairs, best first."""
+        return self.search_many([prompt], k)[0]
+
+    def search_many(self, prompts: list, k: int = 5) -> list:
+        """`search` for a batch of prompts, embedded together and scored with one matrix product."""
+        similarities = self._normalize(self.embedder(prompts)) @ self.matrix.T
+        k = min(k, len(self.names))
+        results = []
+        for row in similarities:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([(self.names[i], float(row[i])) for i in top])
+        return results
+
+class FastPathRouter:
+    """
+    Answers from the nearest agent description when the choice is clear and escalates to `escalate(prompt)`
+    (the LLM) otherwise. The choice is clear when the top-1 similarity beats the top-2 by `margin_threshold`
+    and reaches `min_similarity`; raising either trades GPU cost for accuracy.
+    """
+
+    def __init__(self, index: AgentIndex, escalate, margin_threshold: float = 0.05, min_similarity: float = 0.1):
+        self.index = index
+        self.escalate = escalate
+        self.margin_threshold = margin_threshold
+        self.min_similarity = min_similarity
+
+    def _decide(self, candidates: list) -> tuple:
+        """Returns (fast-path response or None to escalate, top-1 similarity, margin)."""
+        (best, similarity), runner_up = candidates[0], candidates[1:]
+        margin = similarity - (runner_up[0][1] if runner_up else 0.0)
+        if margin >= self.margin_threshold and similarity >= self.min_similarity:
+            return {
+                "recommended_agent": best,
+                "justification": f"The user query is closest to the description of the {best.replace('_', ' ')}.",
+            }, similarity, margin
+        return None, similarity, margin
+
+    def route(self, prompt: str) -> dict:
+        """Returns an `AgentResponse`-shaped dict plus the similarity, margin and whether it escalated."""
+        response, similarity, margin = self._decide(self.index.search(prompt, k=2))
+        escalated = response is None
+        response = dict(self.escalate(prompt)) if escalated else response
+        response.update(similarity=similarity, margin=margin, escalated=escalated)
+        return response
+
+    def route_many(self, prompts: list, escalate_many=None) -> list:
+        """
+        `route` for a batch: one embedding pass, and the unclear prompts escalated together through
+        `escalate_many(prompts) -> [dict]` when given (one `escalate` call per prompt otherwise).
+        """
+        decisions = [self._decide(candidates) for candidates in self.index.search_many(prompts, k=2)]
+        escalations = [i for i, (response, _, _) in enumerate(decisions) if response is None]
+        escalate_many = escalate_many or (lambda batch: [self.escalate(prompt) for prompt in batch])
+        escalated = dict(zip(escalations, escalate_many([prompts[i] for i in escalations]))) if escalations else {}
+        results = []
+        for i, (response, similarity, margin) in enumerate(decisions):
+            response = dict(escalated[i]) if i in escalated else response
+            response.update(similarity=similarity, margin=margin, escalated=i in escalated)
+            results.append(response)
+        return results
@@ -1,11 +1,17 @@
+import argparse
+import json
+import os
+import shutil
 import unsloth
-import datasets
-import pandas as pd
 import transformers
 import trl
 
-#load dataset
-data = pd.read_json("./alpaca_cleaned.json")
+import compactdata
+import routingeval
+import tokencache
+
+#compact dataset: the agent catalog is stored once and every row references it by hash
+data_path = "./alpaca_compact.jsonl"
 
 #finetuning standard dataset template
 data_prompt = """{}
@@ -19,51 +25,116 @@ data_prompt = """{}
 #max sequence length (5020 is good enough)
 max_seq_length = 5020
 
-#load model + tokenizer
+#compute loss on the response tokens only, one length-bucketed example per sequence (False: full-sequence loss over fixed blocks)
+response_only_loss = True
+
+#with response_only_loss, also bin-pack examples into sequences of up to pack_length tokens; off by default, since
+#every example repeats the ~1.3k-token catalog and the tight per-example length never fits two of them
+pack_examples = False
+pack_length = 4096
+
+#train against a one-line-per-agent catalog instead of the full JSON (serve with inference.prompt_from_instruction)
+short_catalog = False
+
+#hold out this fraction of the examples and score routing accuracy on it every eval_steps optimizer steps;
+#the best adapter is kept and training stops after early_stopping_patience evaluations without improvement (0: never)
+held_out_fraction = 0.1
+eval_steps = 10
+early_stopping_patience = 5
+
+#where the fine-tuned adapter is saved
+output_path = "superagent/1B_finetuned_llama3.2"
+
+#continue training this saved adapter instead of a fresh one (incremental catalog updates, see incremental.py)
+resume_adapter = None
+
+num_train_epochs = 40
+learning_rate = 3e-4
+
+#command-line overrides of the settings above, e.g. for incremental.py
+parser = argparse.ArgumentParser(description="Fine-tune the router on the compact dataset.")
+parser.add_argument("--data", default=data_path)
+parser.add_argument("--output", default=output_path)
+parser.add_argument("--resume-adapter", default=resume_adapter)
+parser.add_argument("--epochs", type=float, default=num_train_epochs)
+parser.add_argument("--learning-rate", type=float, default=learning_rate)
+args = parser.parse_args()
+data_path, output_path, resume_adapter = args.data, args.output, args.resume_adapter
+num_train_epochs, learning_rate = args.epochs, args.learning_rate
+
+#load model + tokenizer (the base model, or the base model with the adapter being resumed)
 model, tokenizer = unsloth.FastLanguageModel.from_pretrained(
-    model_name="unsloth/Llama-3.2-1B-bnb-4bit",
+    model_name=resume_adapter or "unsloth/Llama-3.2-1B-bnb-4bit",
     max_seq_length=max_seq_length,
     load_in_4bit=True,
     dtype=None,
 )
 
-#create blank peft addon
-model = unsloth.FastLanguageModel.get_peft_model(
-    model,
-    r=16,
-    lora_alpha=16,
-    lora_dropout=0,
-    target_modules=["q_proj", "k_proj", "v_proj", "up_proj", "down_proj", "o_proj", "gate_proj"],
-    use_rslora=True,
-    use_gradient_checkpointing="unsloth",
-    random_state = 32,
-    loftq_config = None,
-)
+if resume_adapter:
+    #keep training the loaded lora weights
+    unsloth.FastLanguageModel.for_training(model)
+    for name, parameter in model.named_parameters():
+        if "lora_" in name:
+            parameter.requires_grad_(True)
+else:
+    #create blank peft addon
+    model = unsloth.FastLanguageModel.get_peft_model(
+        model,
+        r=16,
+        lora_alpha=16,
+        lora_dropout=0,
+        target_modules=["q_proj", "k_proj", "v_proj", "up_proj", "down_proj", "o_proj", "gate_proj"],
+        use_rslora=True,
+        use_gradient_checkpointing="unsloth",
+        random_state = 32,
+        loftq_config = None,
+    )
 
-#mapping function to format entries
-format_prompt = lambda examples: {
-    'text': [data_prompt.format(system_instruction, input_, output) + tokenizer.eos_token for system_instruction, input_, output in zip(examples['instruction'], examples["input"], examples["output"])]
-}
+# tokenize once into a memory-mapped cache keyed by tokenizer + template + data hash; later runs reuse it
+cache = tokencache.TokenCache(tokencache.build_cache(tokenizer, data_prompt, data_path, short_catalog=short_catalog))
+train_indices, held_out_indices = tokencache.split_indices(len(cache), held_out_fraction)
+if response_only_loss:
+    # tight length: the longest example rounded up (or the packing budget), instead of padding everything to max_seq_length
+    train_seq_length = min(max(tokencache.auto_max_length(cache), pack_length if pack_examples else 0), max_seq_length)
+    training_data = tokencache.MaskedDataset(cache, max_length=train_seq_length, pack=pack_examples, indices=train_indices)
+    data_collator = transformers.DataCollatorForSeq2Seq(tokenizer, label_pad_token_id=-100, pad_to_multiple_of=8)
+    print(f"{len(train_indices)} examples in {len(training_data)} sequences of <= {train_seq_length} tokens "
+          f"({training_data.dropped} too long); loss on {int((cache.lengths - cache.response_starts)[train_indices].sum())} of "
+          f"{int(cache.lengths[train_indices].sum())} tokens")
+else:
+    train_seq_length = max_seq_length
+    training_data = tokencache.PackedDataset(cache, max_seq_length, indices=train_indices)
+    data_collator = None
 
-# load from dataframe to dataset & map into proper format
-training_data = datasets.Dataset.from_pandas(data)
-training_data = training_data.map(format_prompt, batched=True)
+#routing accuracy on the held-out examples by scoring agent names (no generation); keeps the best adapter, stops on a plateau
+routing_eval = None
+if held_out_indices:
+    routing_eval = routingeval.RoutingAccuracyCallback(
+        model,
+        tokenizer,
+        routingeval.load_held_out(data_path, held_out_indices, short_catalog),
+        eval_steps=eval_steps,
+        patience=early_stopping_patience,
+        best_path="output/best",
+    )
 
 #setup trainer
 trainer=trl.SFTTrainer(
     model=model,
     tokenizer=tokenizer,
     train_dataset=training_data,
-    dataset_text_field="text",
-    max_seq_length=max_seq_length,
-    dataset_num_proc=2,
-    packing=True,
+    data_collator=data_collator,
+    max_seq_length=train_seq_length,
+    # already tokenized (and packed, if enabled) by tokencache
+    dataset_kwargs={"skip_prepare_dataset": True},
+    callbacks=[routing_eval] if routing_eval else None,
     args=transformers.TrainingArguments(
-        learning_rate=3e-4,
+        learning_rate=learning_rate,
         lr_scheduler_type="linear",
         per_device_train_batch_size=16,
         gradient_accumulation_steps=8,
-        num_train_epochs=40,
+        num_train_epochs=num_train_epochs,
+        group_by_length=response_only_loss,
         fp16=not unsloth.is_bfloat16_supported(),
         bf16=unsloth.is_bfloat16_supported(),
         logging_steps=1,
@@ -78,6 +149,16 @@ trainer=trl.SFTTrainer(
 #train
 trainer.train()
 
-# save
-model.save_pretrained("superagent/1B_finetuned_llama3.2")
-tokenizer.save_pretrained("superagent/1B_finetuned_llama3.2")
+# save: the best adapter by held-out routing accuracy, otherwise the final one
+if routing_eval and routing_eval.best_step is not None:
+    print(f"Best routing accuracy {routing_eval.best_accuracy:.3f} at step {routing_eval.best_step}")
+    shutil.copytree(routing_eval.best_path, output_path, dirs_exist_ok=True)
+else:
+    model.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+
+#snapshot of the catalog the adapter was trained on (the data's latest), for incremental.py and multi-adapter serving
+with open(os.path.join(output_path, "agents.json"), "w") as f:
+    json.dump(list(compactdata.load_catalogs(data_path).values())[-1]["agents"], f, indent=4)
+
+# for cpu-only serving, export a quantized gguf afterwards: python export.py --quantization int8
@@ -1,59 +1,180 @@
+import argparse
+import difflib
 import json
+import multiprocessing
 import re
+from collections import Counter
 
-# Load agents and prompts
-with open("agents.json", "r") as f:
-    agents = json.load(f)
+from compactdata import CompactWriter, iter_examples
 
-with open("prompts.json", "r") as f:
-    raw_prompts = json.load(f)
+# Compiled once; every raw prompt goes through these
+INDEX_PREFIX = re.compile(r"^\d+\.\s*")
+# `agent name: "prompt"`, the format prompts.json was asked for
+LABELLED_PROMPT = re.compile(r'^([\w\s\-]+):\s*"(.*?)"$')
+SEPARATORS = re.compile(r"[\s\-]+")
+WHITESPACE = re.compile(r"\s*")
 
-def clean_data(raw_prompts, agents):
+class AgentMatcher:
+    """Maps a raw agent name onto the catalog, correcting misspellings (`cocktail_mixologist` -> `cocktail_mixlogist`)."""
+
+    def __init__(self, agents: dict, cutoff: float = 0.85):
+        self.names = list(agents)
+        self.cutoff = cutoff
+        self.memo = {name: name for name in self.names}
+
+    def match(self, raw_name: str):
+        """Returns the catalog name for `raw_name`, or None when nothing is close enough."""
+        name = SEPARATORS.sub("_", raw_name.strip().lower())
+        if name not in self.memo:
+            close = difflib.get_close_matches(name, self.names, n=1, cutoff=self.cutoff)
+            self.memo[name] = close[0] if close else None
+        return self.memo[name]
+
+def iter_json_array(path: str, chunk_size: int = 1 << 20):
+    """Yields the items of a top-level JSON array one by one, reading the file in chunks."""
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size)
+        position = WHITESPACE.match(buffer).end()
+        if not buffer.startswith("[", position):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position += 1
+        eof = False
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if buffer.startswith(",", position):
+                position = WHITESPACE.match(buffer, position + 1).end()
+            if buffer.startswith("]", position):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # A value that runs to the end of the buffer may continue in the next chunk
+                complete = eof or WHITESPACE.match(buffer, end).end() < len(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                more = f.read(chunk_size)
+                eof = not more
+                # The consumed items are dropped only here, so each item is copied once per chunk read, not per item
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            yield item
+            position = end
+
+def iter_raw_prompts(path: str):
+    """Streams raw prompts from a JSON array (prompts.json) or JSONL (promptgen.py's prompts.jsonl)."""
+    if path.endswith(".jsonl"):
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from iter_json_array(path)
+
+def clean_prompt(raw_prompt, matcher: AgentMatcher) -> tuple:
+    """Returns `(row, None)` for a usable prompt, where row is {"input", "agent"}, or `(None, reason)`."""
+    if isinstance(raw_prompt, dict):
+        raw_agent, user_input = raw_prompt.get("agent", ""), raw_prompt.get("prompt", "")
+    else:
+        # Remove leading index (e.g., "1. ") if present
+        raw_prompt = INDEX_PREFIX.sub("", raw_prompt.strip())
+        if not raw_prompt:
+            return None, "empty_input"
+        match = LABELLED_PROMPT.match(raw_prompt)
+        if not match:
+            return None, "malformed"
+        raw_agent, user_input = match.group(1), match.group(2)
+
+    user_input = user_input.strip()
+    if not user_input:
+        return None, "empty_input"
+    agent_name = matcher.match(raw_agent)
+    if agent_name is None:
+        return None, "unknown_agent"
+    return {"input": f"User Input: '{user_input}'", "agent": agent_name}, None
+
+# Per-process state for the worker pool, set once by `_init_worker`
+_matcher = None
+
+def _init_worker(agents: dict, cutoff: float) -> None:
+    global _matcher
+    _matcher = AgentMatcher(agents, cutoff)
+
+def _clean_chunk(chunk: list) -> list:
+    return [(raw_prompt, *clean_prompt(raw_prompt, _matcher)) for raw_prompt in chunk]
+
+def _chunks(items, size: int):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_cleaned(raw_prompts, agents: dict, workers: int = 1, chunk_size: int = 10000, cutoff: float = 0.85):
     """
-    Cleans and structures data into Alpaca format.
-    Handles cases with index prefixes, missing agents, and malformed prompts gracefully.
+    Yields `(raw_prompt, row, reject_reason)` for every raw prompt, in input order.
+    With `workers > 1` the stream is sharded into chunks cleaned by a process pool; only a bounded number of chunks is in flight.
     """
-    agents_keys = set(agents.keys())  # For quick lookup
-    alpaca_data = []
-
-    for raw_prompt in raw_prompts:
-        try:
-            # Remove leading index (e.g., "1. ") if present
-            raw_prompt = re.sub(r"^\d+\.\s*", "", raw_prompt.strip())
-            
-            # Ensure the prompt is valid and extract agent and input
-            match = re.match(r'^([\w\s]+):\s*"(.*?)"$', raw_prompt)
-            if not match:
-                print(f"Skipping malformed prompt: {raw_prompt}")
-                continue
+    if workers <= 1:
+        matcher = AgentMatcher(agents, cutoff)
+        for raw_prompt in raw_prompts:
+            yield (raw_prompt, *clean_prompt(raw_prompt, matcher))
+        return
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(agents, cutoff)) as pool:
+        for results in pool.imap(_clean_chunk, _chunks(raw_prompts, chunk_size)):
+            yield from results
 
-            # Extract agent and input
-            agent_name = match.group(1).strip().lower().replace(" ", "_")
-            user_input = match.group(2).strip()
-
-            if agent_name in agents_keys:
-                # Format in Alpaca style
-                alpaca_data.append({
-                    "instruction": f"You are an assistant that strictly outputs JSON-formatted responses.\n\nAgents:\n{json.dumps(agents, indent=4)}\n\nRespond with the following JSON structure:\n{{\n    \"recommended_agent\": \"<agent_name>\",\n    \"justification\": \"<reason for selecting the agent>\"\n}}",
-                    "input": f"User Input: '{user_input}'",
-                    "output": json.dumps({
-                        "recommended_agent": agent_name,
-                        "justification": f"The user query matches the functionality of the {agent_name.replace('_', ' ')}."
-                    }, indent=4)
-                })
-            else:
-                print(f"Skipping unknown agent: {agent_name}")
-        except Exception as e:
-            print(f"Error processing prompt '{raw_prompt}': {e}")
+def clean_data(raw_prompts, agents) -> list:
+    """
+    Cleans and structures data into compact rows ({"input", "agent"}); the catalog itself is written once by the caller.
+    Handles cases with index prefixes, misspelled agents, and malformed prompts gracefully.
+    """
+    return [row for _, row, _ in iter_cleaned(raw_prompts, agents) if row is not None]
 
-    return alpaca_data
+def run_pipeline(input_path: str, output_path: str, agents: dict, rejects_path: str = "rejects.jsonl",
+                 workers: int = 1, chunk_size: int = 10000, cutoff: float = 0.85) -> dict:
+    """Streams `input_path` into the compact dataset at `output_path`, logging rejects; returns counts by outcome."""
+    counts = Counter()
+    with CompactWriter(output_path) as writer, open(rejects_path, "w") as rejects:
+        catalog = writer.add_catalog(agents)
+        for raw_prompt, row, reason in iter_cleaned(iter_raw_prompts(input_path), agents, workers, chunk_size, cutoff):
+            if row is None:
+                counts[reason] += 1
+                rejects.write(json.dumps({"reason": reason, "raw": raw_prompt}) + "\n")
+            else:
+                counts["kept"] += 1
+                writer.add_example(catalog, row["input"], row["agent"])
+    return dict(counts)
 
 if __name__ == "__main__":
-    print("Cleaning data...")
-    cleaned_data = clean_data(raw_prompts, agents)
+    parser = argparse.ArgumentParser(description="Clean generated prompts into the compact training dataset.")
+    parser.add_argument("--input", default="prompts.json", help="JSON array or JSONL of raw prompts.")
+    parser.add_argument("--output", default="alpaca_compact.jsonl")
+    parser.add_argument("--rejects", default="rejects.jsonl", help="Where skipped prompts are logged with their reason.")
+    parser.add_argument("--agents", default="agents.json")
+    parser.add_argument("--workers", type=int, default=1, help="Processes to shard cleaning across (worth it for millions of prompts).")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--fuzzy-cutoff", type=float, default=0.85, help="Minimum difflib similarity to accept a misspelled agent name.")
+    parser.add_argument("--legacy-json", action="store_true", help="Also expand the result into alpaca_cleaned.json (an untracked export for tools that expect it).")
+    args = parser.parse_args()
 
-    # Save cleaned data to JSON
-    with open("alpaca_cleaned.json", "w") as f:
-        json.dump(cleaned_data, f, indent=4)
+    # Load agents
+    with open(args.agents, "r") as f:
+        agents = json.load(f)
+
+    print("Cleaning data...")
+    counts = run_pipeline(args.input, args.output, agents, args.rejects, args.workers, args.chunk_size, args.fuzzy_cutoff)
+    rejected = {reason: count for reason, count in counts.items() if reason != "kept"}
+    print(f"Kept {counts.get('kept', 0)} prompts in {args.output}; rejected {sum(rejected.values())} {rejected} (see {args.rejects})")
 
-    print("Cleaned Alpaca-style dataset saved to alpaca_cleaned.json!")
+    # The expanded Alpaca-style JSON is still available for tools that expect it
+    if args.legacy_json:
+        with open("alpaca_cleaned.json", "w") as f:
+            json.dump(list(iter_examples(args.output)), f, indent=4)
+        print("Expanded Alpaca-style dataset saved to alpaca_cleaned.json!")
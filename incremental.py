@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+
+import compactdata
+import generatecleandata
+
+def load_catalog_snapshot(adapter_path: str) -> dict:
+    """The catalog an adapter was trained on, as finetune.py saves it next to the adapter."""
+    with open(os.path.join(adapter_path, "agents.json"), "r") as f:
+        return json.load(f)
+
+def diff_catalogs(old: dict, new: dict) -> dict:
+    """Agent names that were added, whose description changed, that were removed, and that are unchanged."""
+    return {
+        "added": [agent for agent in new if agent not in old],
+        "changed": [agent for agent in new if agent in old and new[agent] != old[agent]],
+        "removed": [agent for agent in old if agent not in new],
+        "unchanged": [agent for agent in new if agent in old and new[agent] == old[agent]],
+    }
+
+def generate_prompts(catalog: dict, agents: list, output_path: str, num_prompts: int = 500, api_base: str = None) -> dict:
+    """Generates raw prompts for `agents` only, at the per-agent quota a full `num_prompts` run over `catalog` would use."""
+    import openai
+    import promptgen
+    if api_base:
+        openai.api_base = api_base
+        openai.api_key = openai.api_key or "stub"
+    return asyncio.run(promptgen.generate_user_prompts(output_path, num_prompts=num_prompts, catalog=catalog, target_agents=agents))
+
+def clean_prompts(raw_path: str, catalog: dict, agents: list, rejects_path: str) -> list:
+    """Cleaned `(user_input, agent)` rows for `agents` from raw prompts; everything else is logged to `rejects_path`."""
+    wanted = set(agents)
+    rows = []
+    with open(rejects_path, "w") as rejects:
+        for raw_prompt, row, reason in generatecleandata.iter_cleaned(generatecleandata.iter_raw_prompts(raw_path), catalog):
+            if row is not None and row["agent"] not in wanted:
+                row, reason = None, "not_updated_agent"
+            if row is None:
+                rejects.write(json.dumps({"reason": reason, "raw": raw_prompt}) + "\n")
+            else:
+                rows.append((row["input"], row["agent"]))
+    return rows
+
+def iter_replayable(data_path: str, agents: list):
+    """Old training examples whose agent is still in the catalog with the same description, as `(input, agent, justification)`."""
+    keep = set(agents)
+    for record in compactdata.iter_records(data_path):
+        if record["type"] == "example" and record["agent"] in keep:
+            yield record["input"], record["agent"], record.get("justification")
+
+def build_datasets(data_path: str, catalog: dict, diff: dict, new_rows: list, train_path: str, merged_path: str,
+                   replay_ratio: float = 1.0, min_replay: int = 100, seed: int = 0) -> dict:
+    """
+    Writes two compact datasets under the new catalog: `train_path` with the new rows plus a random replay
+    sample of old examples (`replay_ratio` per new row, at least `min_replay`) so the adapter does not forget
+    the unchanged agents, and `merged_path` with every new row and every still-valid old example, which replaces
+    the full dataset for later runs. Old examples of changed or removed agents are dropped from both.
+    """
+    replayable = list(iter_replayable(data_path, diff["unchanged"]))
+    replay_count = min(len(replayable), max(int(replay_ratio * len(new_rows)), min_replay))
+    replay = random.Random(seed).sample(replayable, replay_count)
+    new_examples = [(user_input, agent, None) for user_input, agent in new_rows]
+    for path, examples in ((train_path, new_examples + replay), (merged_path, replayable + new_examples)):
+        with compactdata.CompactWriter(path) as writer:
+            catalog_id = writer.add_catalog(catalog)
+            for user_input, agent, justification in examples:
+                writer.add_example(catalog_id, user_input, agent, justification)
+    return {"new": len(new_rows), "replay": replay_count, "replayable": len(replayable), "merged": len(replayable) + len(new_rows)}
+
+def resume_training(adapter_path: str, train_path: str, output_path: str, epochs: float = 10, learning_rate: float = 1e-4) -> None:
+    """Continues training the adapter on the incremental dataset with finetune.py."""
+    subprocess.run([
+        sys.executable, "finetune.py",
+        "--data", train_path,
+        "--resume-adapter", adapter_path,
+        "--output", output_path,
+        "--epochs", str(epochs),
+        "--learning-rate", str(learning_rate),
+    ], check=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the fine-tuned router for catalog changes without retraining from scratch.")
+    parser.add_argument("--adapter", default="superagent/1B_finetuned_llama3.2", help="The adapter to update (with its agents.json snapshot).")
+    parser.add_argument("--old-catalog", help="The catalog the adapter was trained on, for adapters saved without a snapshot.")
+    parser.add_argument("--catalog", default="agents.json", help="The updated catalog.")
+    parser.add_argument("--data", default="alpaca_compact.jsonl", help="The adapter's training data, sampled for replay.")
+    parser.add_argument("--work-dir", default="incremental")
+    parser.add_argument("--prompts", help="Raw prompts for the new/changed agents (promptgen.py format) instead of generating them.")
+    parser.add_argument("--api-base", help="OpenAI-compatible endpoint for prompt generation, e.g. a local stub_server.py.")
+    parser.add_argument("--num-prompts", type=int, default=500, help="Prompts a full promptgen.py run would generate; sets the per-agent quota.")
+    parser.add_argument("--replay-ratio", type=float, default=1.0, help="Old examples replayed per new example.")
+    parser.add_argument("--min-replay", type=int, default=100)
+    parser.add_argument("--update-data", action="store_true", help="Replace --data with the merged dataset.")
+    parser.add_argument("--train", action="store_true", help="Resume training the adapter on the incremental dataset.")
+    parser.add_argument("--output", help="Where the updated adapter is saved (default: <adapter>-incremental).")
+    parser.add_argument("--epochs", type=float, default=10)
+    parser.add_argument("--learning-rate", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    if args.old_catalog:
+        with open(args.old_catalog, "r") as f:
+            old_catalog = json.load(f)
+    else:
+        old_catalog = load_catalog_snapshot(args.adapter)
+    with open(args.catalog, "r") as f:
+        catalog = json.load(f)
+    diff = diff_catalogs(old_catalog, catalog)
+    print(json.dumps({key: value for key, value in diff.items() if key != "unchanged"}, indent=4))
+    if not (diff["added"] or diff["changed"] or diff["removed"]):
+        print("The catalog matches the adapter's; nothing to do.")
+        sys.exit(0)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    updated = diff["added"] + diff["changed"]
+    raw_path = args.prompts or os.path.join(args.work_dir, "prompts.jsonl")
+    if updated and not args.prompts:
+        print(f"Generating prompts for {len(updated)} new or changed agents...")
+        summary = generate_prompts(catalog, updated, raw_path, args.num_prompts, args.api_base)
+        print(f"{sum(summary['counts'].values())} prompts in {raw_path}")
+    rejects_path = os.path.join(args.work_dir, "rejects.jsonl")
+    new_rows = clean_prompts(raw_path, catalog, updated, rejects_path) if updated else []
+    if updated and not new_rows:
+        # Training on the replay sample alone would leave the new and changed agents unlearned
+        sys.exit(f"No usable prompts for the {len(updated)} new or changed agents in {raw_path} (see {rejects_path}); "
+                 "fix prompt generation or pass --prompts, then rerun.")
+
+    train_path = os.path.join(args.work_dir, "train.jsonl")
+    merged_path = os.path.join(args.work_dir, "merged.jsonl")
+    counts = build_datasets(args.data, catalog, diff, new_rows, train_path, merged_path, args.replay_ratio, args.min_replay)
+    print(f"{counts['new']} new examples + {counts['replay']} replayed in {train_path}; {counts['merged']} examples in {merged_path}")
+    if args.update_data:
+        os.replace(merged_path, args.data)
+        print(f"{args.data} now holds the merged dataset")
+
+    if args.train:
+        output = args.output or args.adapter.rstrip("/") + "-incremental"
+        resume_training(args.adapter, train_path, output, args.epochs, args.learning_rate)
+        print(f"Updated adapter saved to {output}")
@@ -1,18 +1,25 @@
+import argparse
+import collections
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import threading
+import torch
+import transformers
 import unsloth
+import compactdata
+import telemetry
+from constrained import AgentTrie, agent_response_model, constrained_generation_kwargs
 
-# Load model and tokenizer
-model, tokenizer = unsloth.FastLanguageModel.from_pretrained(
-    model_name="superagent/1B_finetuned_llama3.2",
-    max_seq_length=5020,
-    dtype=None,
-    load_in_4bit=True
-)
-
-# Uncomment this line if necessary; otherwise, comment it out
-model = unsloth.FastLanguageModel.for_inference(model)
-
-# Define user input
-text = "i wanna learn how to write a book"
+# Default fine-tuned checkpoint and the sample input used for warm-up
+MODEL_NAME = "superagent/1B_finetuned_llama3.2"
+# Base model every adapter from finetune.py is trained on
+BASE_MODEL = "unsloth/Llama-3.2-1B-bnb-4bit"
+WARM_UP_TEXT = "i wanna learn how to write a book"
+# Passed to GPU spans so queued kernels are charged to the span that launched them (only called while telemetry is on)
+CUDA_SYNC = torch.cuda.synchronize if torch.cuda.is_available() else None
 
 # Corrected `data_prompt` with escaped curly braces
 data_prompt = """You are an assistant that strictly outputs JSON-formatted responses.
@@ -65,24 +72,518 @@ Respond with the following JSON structure:
 {answer}
 """
 
-# Ensure placeholders are passed correctly to `format()`
-inputs = tokenizer(
-    [
-        data_prompt.format(
-            text=text,  # User input
-            answer="",  # Placeholder for the expected answer
-        )
-    ],
-    return_tensors="pt"
-).to("cuda")
+def prompt_from_instruction(instruction: str) -> str:
+    """
+    Builds a `data_prompt`-style template around a training instruction, e.g. for a model trained with
+    `short_catalog=True`: `inference.data_prompt = prompt_from_instruction(compactdata.build_instruction(agents, short=True))`.
+    """
+    escaped = instruction.replace("{", "{{").replace("}", "}}")
+    return escaped + "\n\n### Input:\n{text}\n\n### Response:\n{answer}\n"
+
+def split_prompt(prompt_template: str) -> tuple:
+    """Splits a prompt template into its static header and the per-request suffix template."""
+    header, marker, rest = prompt_template.partition("{text}")
+    # The header only contains escaped braces, so formatting it just unescapes them
+    return header.format(), marker + rest
+
+# Start of every response up to the agent name, matching the `json.dumps(..., indent=4)` training outputs
+RESPONSE_HEAD = '{\n    "recommended_agent": "'
+JUSTIFICATION_HEAD = '",\n    "justification": "'
+
+def _repeat_cache(past_key_values, repeats: int):
+    """Copies every row of a cache `repeats` times along the batch dimension (row-major)."""
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(tuple(t.repeat_interleave(repeats, dim=0) for t in layer) for layer in past_key_values)
+
+class FinetunedRouter:
+    """
+    Fine-tuned router with the model loaded on first use.
+    Loads either the unsloth checkpoint `model_name` or, when `snapshot_path` is set, a snapshot written by
+    `save_snapshot()` that already holds the quantized, merged weights.
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME, snapshot_path: str = None, max_seq_length: int = 5020, catalog_path: str = "agents.json"):
+        self.model_name = model_name
+        self.snapshot_path = snapshot_path
+        self.max_seq_length = max_seq_length
+        self.catalog_path = catalog_path
+        self._model = None
+        self._tokenizer = None
+        self._agents = None
+        self._load_lock = threading.Lock()
+        # Past-key-values of the static header, rebuilt whenever the header text (and so the catalog) changes
+        self._prefix_cache = {"key": None, "input_ids": None, "past_key_values": None}
+        self._agent_trie = {"key": None, "trie": None}
+        # Prompt template for this router's catalog; None uses the module-level `data_prompt`
+        self.prompt_template = None
+
+    @classmethod
+    def from_loaded(cls, model, tokenizer, agents: dict, prompt_template: str = None) -> "FinetunedRouter":
+        """Wraps an already loaded model and tokenizer, e.g. the model being trained, routing over `agents`."""
+        router = cls()
+        router._model, router._tokenizer, router._agents = model, tokenizer, agents
+        router.prompt_template = prompt_template
+        return router
+
+    def load(self) -> None:
+        """Loads the model and tokenizer if they are not loaded yet."""
+        with self._load_lock:
+            if self._model is not None:
+                return
+            if self.snapshot_path:
+                # The snapshot's config carries its quantization settings, so the weights load as saved
+                model = transformers.AutoModelForCausalLM.from_pretrained(self.snapshot_path, device_map="cuda")
+                tokenizer = transformers.AutoTokenizer.from_pretrained(self.snapshot_path)
+                model.eval()
+            else:
+                model, tokenizer = unsloth.FastLanguageModel.from_pretrained(
+                    model_name=self.model_name,
+                    max_seq_length=self.max_seq_length,
+                    dtype=None,
+                    load_in_4bit=True
+                )
+                model = unsloth.FastLanguageModel.for_inference(model)
+            self._model, self._tokenizer = model, tokenizer
+
+    @property
+    def model(self):
+        self.load()
+        return self._model
+
+    @property
+    def tokenizer(self):
+        self.load()
+        return self._tokenizer
+
+    @property
+    def agents(self) -> dict:
+        """Agent catalog the router chooses from."""
+        if self._agents is None:
+            with open(self.catalog_path, "r") as f:
+                self._agents = json.load(f)
+        return self._agents
+
+    def catalog(self, adapter: str = None) -> dict:
+        """The agent catalog `adapter` routes over, without loading the model."""
+        with self.using(adapter):
+            return self.agents
+
+    # Only a `MultiAdapterRouter` switches adapters
+    active_adapter = None
+
+    @property
+    def template(self) -> str:
+        return self.prompt_template or data_prompt
+
+    def using(self, adapter: str = None):
+        """Context for routing with `adapter`; a single-model router only has the default (None)."""
+        if adapter is not None:
+            raise ValueError(f"Unknown adapter {adapter!r}: this router serves a single model")
+        return contextlib.nullcontext(self)
+
+    def warm_up(self) -> None:
+        """Loads the model, prefills the header, tokenizes the agent names and routes one sample input."""
+        self.classify_agent(WARM_UP_TEXT)
+
+    def save_snapshot(self, path: str) -> None:
+        """Writes the loaded, quantized model with its adapter merged so later loads skip the unsloth setup."""
+        if hasattr(self.model, "save_pretrained_merged"):
+            self.model.save_pretrained_merged(path, self.tokenizer, save_method="merged_4bit_forced")
+        else:
+            self.model.save_pretrained(path)
+            self.tokenizer.save_pretrained(path)
+
+    def close(self) -> None:
+        """Drops the model, tokenizer and caches and releases their GPU memory."""
+        with self._load_lock:
+            self._model = None
+            self._tokenizer = None
+            self._prefix_cache = {"key": None, "input_ids": None, "past_key_values": None}
+            self._agent_trie = {"key": None, "trie": None}
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get_prefix_cache(self) -> dict:
+        """Prefills the static `data_prompt` header once and keeps its past-key-values resident."""
+        header, _ = split_prompt(self.template)
+        key = hashlib.sha256(header.encode("utf-8")).hexdigest()
+        if self._prefix_cache["key"] != key:
+            input_ids = self.tokenizer(header, return_tensors="pt").input_ids.to("cuda")
+            with torch.no_grad(), telemetry.span("finetuned.prefix_prefill", sync=CUDA_SYNC, tokens=input_ids.shape[1]):
+                past_key_values = self.model(input_ids=input_ids, use_cache=True).past_key_values
+            self._prefix_cache = {"key": key, "input_ids": input_ids, "past_key_values": past_key_values}
+        return self._prefix_cache
+
+    def _pad_token_id(self) -> int:
+        return self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+
+    def _suffix_text(self, text: str, answer: str = None) -> str:
+        """Formats the per-request suffix; a given `answer` (even "") is continued directly instead of after a newline."""
+        _, suffix_template = split_prompt(self.template)
+        suffix = suffix_template.format(text=text, answer=answer or "")
+        if answer is not None:
+            suffix = suffix.removesuffix("\n")
+        return suffix
+
+    def _batch_inputs(self, texts: list, answers: list = None, use_prefix_cache: bool = True) -> tuple:
+        """
+        Builds `[header][left padding][suffix]` rows, so the shared header keeps positions 0..P-1 in every row
+        and the cached header can be reused for the whole batch.
+        """
+        if use_prefix_cache:
+            prefix = self.get_prefix_cache()
+        else:
+            header, _ = split_prompt(self.template)
+            prefix = {"input_ids": self.tokenizer(header, return_tensors="pt").input_ids.to("cuda"), "past_key_values": None}
+        answers = answers if answers is not None else [None] * len(texts)
+        with telemetry.span("finetuned.prompt_build", rows=len(texts)):
+            suffix_texts = [self._suffix_text(text, answer) for text, answer in zip(texts, answers)]
+        with telemetry.span("finetuned.tokenize", rows=len(texts)):
+            suffixes = [self.tokenizer(suffix, add_special_tokens=False).input_ids for suffix in suffix_texts]
+
+        width = max(len(token_ids) for token_ids in suffixes)
+        suffix_ids = torch.full((len(texts), width), self._pad_token_id(), dtype=torch.long)
+        suffix_mask = torch.zeros((len(texts), width), dtype=torch.long)
+        for row, token_ids in enumerate(suffixes):
+            if token_ids:
+                suffix_ids[row, width - len(token_ids):] = torch.tensor(token_ids)
+                suffix_mask[row, width - len(token_ids):] = 1
+
+        prefix_ids = prefix["input_ids"].expand(len(texts), -1)
+        input_ids = torch.cat([prefix_ids, suffix_ids.to("cuda")], dim=-1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), suffix_mask.to("cuda")], dim=-1)
+        return prefix, input_ids, attention_mask
+
+    def _generate(self, texts: list, max_new_tokens: int, use_prefix_cache: bool = True, answers: list = None, **generate_kwargs) -> tuple:
+        """Runs one batched `generate()` over `texts` and returns the inputs alongside the outputs."""
+        prefix, input_ids, attention_mask = self._batch_inputs(texts, answers, use_prefix_cache)
+        if use_prefix_cache:
+            # generate() extends the cache in place, so every call works on its own copy
+            generate_kwargs["past_key_values"] = _repeat_cache(prefix["past_key_values"], len(texts))
+        with telemetry.span("finetuned.decode", sync=CUDA_SYNC, rows=len(texts), max_new_tokens=max_new_tokens) as span:
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
+                **generate_kwargs
+            )
+            span.set(new_tokens=outputs.shape[1] - input_ids.shape[1])
+        return input_ids, outputs
+
+    def generate_answers(self, texts: list, max_new_tokens: int = 5020, use_prefix_cache: bool = True, answers: list = None, **generate_kwargs) -> list:
+        """Generates the raw model output for a batch of texts, prefilling only the `### Input:` suffixes when the prefix cache is on."""
+        _, outputs = self._generate(texts, max_new_tokens, use_prefix_cache, answers, **generate_kwargs)
+        with telemetry.span("finetuned.batch_decode", rows=len(texts)):
+            return self.tokenizer.batch_decode(outputs)
+
+    def generate_answer(self, text: str, max_new_tokens: int = 5020, use_prefix_cache: bool = True, answer: str = None, **generate_kwargs) -> str:
+        """Generates the raw model output for `text`."""
+        return self.generate_answers([text], max_new_tokens, use_prefix_cache, [answer], **generate_kwargs)[0]
+
+    def generate_responses(self, texts: list, max_justification_tokens: int = 64, agent_names: list = None) -> list:
+        """
+        Generates full `AgentResponse`s with grammar-constrained decoding over the router's catalog (or `agent_names`).
+        The outputs always parse and decoding stops as soon as every closing brace is emitted.
+        """
+        response_model = agent_response_model(list(agent_names or self.agents))
+        kwargs = constrained_generation_kwargs(self.tokenizer, response_model, max_justification_tokens)
+        input_ids, outputs = self._generate(texts, answers=[""] * len(texts), **kwargs)
+        with telemetry.span("finetuned.batch_decode", rows=len(texts)):
+            responses = self.tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        with telemetry.span("finetuned.parse", rows=len(texts)):
+            return [response_model(**json.loads(response)).dict() for response in responses]
+
+    def generate_response(self, text: str, max_justification_tokens: int = 64, agent_names: list = None) -> dict:
+        """Generates a full `AgentResponse` for `text` with grammar-constrained decoding."""
+        return self.generate_responses([text], max_justification_tokens, agent_names)[0]
+
+    def _agent_token_ids(self, agent: str) -> list:
+        """
+        Tokenizes `agent` and the first token after it as they appear in a full response, where the name is followed
+        by `JUSTIFICATION_HEAD`: BPE can merge the closing quote with what comes next, so it is not scored on its own.
+        """
+        head_ids = self.tokenizer(RESPONSE_HEAD, add_special_tokens=False).input_ids
+        encoding = self.tokenizer(RESPONSE_HEAD + agent + JUSTIFICATION_HEAD, add_special_tokens=False, return_offsets_mapping=True)
+        start, name_end = len(head_ids), len(RESPONSE_HEAD) + len(agent)
+        if encoding.input_ids[:start] != head_ids:
+            encoding = self.tokenizer(agent + JUSTIFICATION_HEAD, add_special_tokens=False, return_offsets_mapping=True)
+            start, name_end = 0, len(agent)
+        token_ids = []
+        for token_id, (_, end) in zip(encoding.input_ids[start:], encoding.offset_mapping[start:]):
+            token_ids.append(token_id)
+            # Stops at the first token that reaches past the name, i.e. the one that opens the terminator
+            if end > name_end:
+                break
+        return token_ids
+
+    def get_agent_trie(self, agent_names: list = None) -> AgentTrie:
+        """Builds (once per catalog) the trie of tokenized agent names."""
+        agent_names = list(agent_names or self.agents)
+        key = tuple(agent_names)
+        if self._agent_trie["key"] != key:
+            self._agent_trie.update(key=key, trie=AgentTrie({agent: self._agent_token_ids(agent) for agent in agent_names}))
+        return self._agent_trie["trie"]
+
+    def score_agents_batch(self, texts: list, agent_names: list = None, batch_size: int = 32) -> list:
+        """
+        Scores every agent name as the continuation of `RESPONSE_HEAD` for each of `texts`.
+        Returns, per text, the agents ranked by probability renormalized over the closed set of names.
+        `batch_size` bounds both the texts prefilled together and the (text, name) rows scored per forward pass,
+        since each row holds a copy of its context cache.
+        """
+        rankings = []
+        for start in range(0, len(texts), batch_size):
+            rankings += self._score_agents_chunk(texts[start:start + batch_size], agent_names, batch_size)
+        return rankings
+
+    def _score_agents_chunk(self, texts: list, agent_names: list, batch_size: int) -> list:
+        trie = self.get_agent_trie(agent_names)
+        names = list(trie.sequences)
+        prefix, input_ids, attention_mask = self._batch_inputs(texts, [RESPONSE_HEAD] * len(texts))
+        prefix_length = prefix["input_ids"].shape[1]
+        # Explicit positions skip the padding between the header and each suffix
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        with torch.inference_mode():
+            with telemetry.span("finetuned.prefill", sync=CUDA_SYNC, rows=len(texts), tokens=input_ids.shape[1] - prefix_length):
+                context = self.model(
+                    input_ids=input_ids[:, prefix_length:],
+                    attention_mask=attention_mask,
+                    position_ids=position_ids[:, prefix_length:],
+                    past_key_values=_repeat_cache(prefix["past_key_values"], len(texts)),
+                    use_cache=True
+                )
+            with telemetry.span("finetuned.score_names", sync=CUDA_SYNC, rows=len(texts), names=len(names)):
+                # The first token of every name is scored straight off each context's next-token distribution
+                first_logprobs = torch.log_softmax(context.logits[:, -1].float(), dim=-1)
+                first_ids = torch.tensor([trie.sequences[name][0] for name in names], device="cuda")
+                scores = first_logprobs[:, first_ids]
+                next_positions = attention_mask.sum(dim=-1)
+
+                # The remaining tokens of all names are scored together, rows ordered text-major
+                chunk_size = max(1, batch_size // len(texts))
+                for start in range(0, len(names), chunk_size):
+                    chunk = names[start:start + chunk_size]
+                    width = max(len(trie.sequences[name]) for name in chunk) - 1
+                    if width == 0:
+                        continue
+                    chunk_ids = torch.full((len(chunk), width), self._pad_token_id(), dtype=torch.long)
+                    targets = torch.zeros((len(chunk), width), dtype=torch.long)
+                    valid = torch.zeros((len(chunk), width), dtype=torch.long)
+                    for row, name in enumerate(chunk):
+                        token_ids = trie.sequences[name]
+                        length = len(token_ids) - 1
+                        if length == 0:
+                            continue
+                        chunk_ids[row, :length] = torch.tensor(token_ids[:-1])
+                        targets[row, :length] = torch.tensor(token_ids[1:])
+                        valid[row, :length] = 1
+                    chunk_ids, targets, valid = (t.to("cuda").repeat(len(texts), 1) for t in (chunk_ids, targets, valid))
+
+                    logits = self.model(
+                        input_ids=chunk_ids,
+                        attention_mask=torch.cat([attention_mask.repeat_interleave(len(chunk), dim=0), valid], dim=-1),
+                        position_ids=next_positions.repeat_interleave(len(chunk))[:, None] + torch.arange(width, device="cuda"),
+                        past_key_values=_repeat_cache(context.past_key_values, len(chunk)),
+                        use_cache=True
+                    ).logits.float()
+                    token_logprobs = logits.gather(-1, targets.unsqueeze(-1)).squeeze(-1) - logits.logsumexp(dim=-1)
+                    scores[:, start:start + len(chunk)] += (token_logprobs * valid).sum(dim=-1).view(len(texts), len(chunk))
+
+        with telemetry.span("finetuned.rank", rows=len(texts)):
+            rankings = []
+            for row_scores in scores:
+                ranking = [
+                    {"agent": name, "probability": probability, "logprob": logprob}
+                    for name, probability, logprob in zip(names, torch.softmax(row_scores, dim=0).tolist(), row_scores.tolist())
+                ]
+                rankings.append(sorted(ranking, key=lambda entry: entry["logprob"], reverse=True))
+        return rankings
+
+    def score_agents(self, text: str, agent_names: list = None, batch_size: int = 32) -> list:
+        """Scores every agent name for `text` and returns them ranked by probability."""
+        return self.score_agents_batch([text], agent_names, batch_size)[0]
+
+    def generate_justifications(self, texts: list, chosen_agents: list, max_new_tokens: int = 64) -> list:
+        """Generates the justifications for already chosen agents under their own token budget."""
+        answers = [RESPONSE_HEAD + agent + JUSTIFICATION_HEAD for agent in chosen_agents]
+        raw_answers = self.generate_answers(texts, max_new_tokens=max_new_tokens, answers=answers)
+        justifications = []
+        with telemetry.span("finetuned.parse", rows=len(texts)):
+            for raw_answer in raw_answers:
+                justification = raw_answer.split('"justification": "')[-1]
+                justifications.append(justification.split('"')[0].strip())
+        return justifications
+
+    def generate_justification(self, text: str, agent: str, max_new_tokens: int = 64) -> str:
+        """Generates the justification for an already chosen agent."""
+        return self.generate_justifications([text], [agent], max_new_tokens)[0]
+
+    def classify_agents(self, texts: list, top_k: int = None, justify: bool = False, max_justification_tokens: int = 64, agent_names: list = None) -> list:
+        """
+        Routes a batch of texts with a bounded-cost scoring pass instead of free-form generation.
+        Justifications are only generated when `justify` is set.
+        """
+        results = []
+        with telemetry.span("finetuned.classify", rows=len(texts), justify=justify):
+            for ranking in self.score_agents_batch(texts, agent_names=agent_names):
+                results.append({"recommended_agent": ranking[0]["agent"], "ranking": ranking[:top_k] if top_k else ranking})
+            if justify:
+                chosen_agents = [result["recommended_agent"] for result in results]
+                for result, justification in zip(results, self.generate_justifications(texts, chosen_agents, max_justification_tokens)):
+                    result["justification"] = justification
+        telemetry.count("finetuned_rows_total", len(texts))
+        return results
+
+    def classify_agent(self, text: str, top_k: int = None, justify: bool = False, max_justification_tokens: int = 64, agent_names: list = None) -> dict:
+        """Routes `text` with a bounded-cost scoring pass instead of free-form generation."""
+        return self.classify_agents([text], top_k, justify, max_justification_tokens, agent_names)[0]
+
+class MultiAdapterRouter(FinetunedRouter):
+    """
+    One base model shared by many LoRA adapters from finetune.py (e.g. one per catalog or tenant), with at most
+    `max_adapters` resident. `adapters` maps names to adapter directories; an adapter routes over the `agents.json`
+    saved next to it, or `catalog_path`. Call the `FinetunedRouter` methods inside `with router.using(name):`,
+    which loads the adapter on first use, evicts the least recently used one when full, and makes it active.
+    """
+
+    # Everything that depends on the active adapter and its catalog, swapped in and out with it
+    ADAPTER_STATE = ("_prefix_cache", "_agent_trie", "_agents", "prompt_template")
+
+    def __init__(self, adapters: dict, base_model: str = BASE_MODEL, max_adapters: int = 4, default_adapter: str = None,
+                 max_seq_length: int = 5020, catalog_path: str = "agents.json"):
+        super().__init__(model_name=base_model, max_seq_length=max_seq_length, catalog_path=catalog_path)
+        self.adapters = dict(adapters)
+        self.max_adapters = max(1, max_adapters)
+        self.default_adapter = default_adapter or next(iter(self.adapters))
+        # Least recently used first: adapter name -> its saved `ADAPTER_STATE`
+        self._resident = collections.OrderedDict()
+        self._active = None
+        self._adapter_lock = threading.RLock()
+
+    def catalog(self, adapter: str = None) -> dict:
+        name = adapter or self.default_adapter
+        if name not in self.adapters:
+            raise ValueError(f"Unknown adapter {name!r}")
+        catalog_path = os.path.join(self.adapters[name], "agents.json")
+        with open(catalog_path if os.path.exists(catalog_path) else self.catalog_path, "r") as f:
+            return json.load(f)
+
+    def _adapter_state(self, name: str) -> dict:
+        agents = self.catalog(name)
+        return {
+            "_prefix_cache": {"key": None, "input_ids": None, "past_key_values": None},
+            "_agent_trie": {"key": None, "trie": None},
+            "_agents": agents,
+            "prompt_template": prompt_from_instruction(compactdata.build_instruction(agents)),
+        }
+
+    def _load_adapter(self, name: str) -> None:
+        import peft
+        if name not in self.adapters:
+            raise ValueError(f"Unknown adapter {name!r}")
+        with telemetry.span("finetuned.adapter_load", adapter=name):
+            if isinstance(self.model, peft.PeftModel):
+                self._model.load_adapter(self.adapters[name], adapter_name=name)
+            else:
+                self._model = peft.PeftModel.from_pretrained(self.model, self.adapters[name], adapter_name=name)
+                self._model.eval()
+        self._resident[name] = self._adapter_state(name)
+        # The new adapter is loaded before the coldest is dropped, since a PeftModel always needs one
+        while len(self._resident) > self.max_adapters:
+            evicted, _ = self._resident.popitem(last=False)
+            if evicted == self._active:
+                self._active = None
+            self._model.delete_adapter(evicted)
+            telemetry.count("adapter_evictions_total")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _activate(self, name: str) -> None:
+        if name != self._active:
+            if self._active is not None:
+                self._resident[self._active] = {attribute: getattr(self, attribute) for attribute in self.ADAPTER_STATE}
+            if name not in self._resident:
+                self._load_adapter(name)
+            for attribute, value in self._resident[name].items():
+                setattr(self, attribute, value)
+            self._model.set_adapter(name)
+            self._active = name
+            telemetry.count("adapter_switches_total")
+        self._resident.move_to_end(name)
+
+    @contextlib.contextmanager
+    def using(self, adapter: str = None):
+        """Routes with `adapter` (default: `default_adapter`) for the duration of the block; other threads wait."""
+        with self._adapter_lock:
+            self._activate(adapter or self.default_adapter)
+            yield self
+
+    @property
+    def active_adapter(self) -> str:
+        return self._active
+
+    @property
+    def resident_adapters(self) -> list:
+        """Resident adapter names, least recently used first."""
+        return list(self._resident)
+
+    def warm_up(self) -> None:
+        with self.using():
+            super().warm_up()
+
+    def close(self) -> None:
+        with self._adapter_lock:
+            self._resident.clear()
+            self._active = None
+            super().close()
+
+_router = None
+_router_lock = threading.Lock()
+
+def get_router(warm_up: bool = False, **router_kwargs) -> FinetunedRouter:
+    """
+    Returns the process-wide router, creating it on first use; `router_kwargs` only apply to that first call.
+    With an `adapters` mapping it is a `MultiAdapterRouter`. The model itself is loaded lazily unless `warm_up` is set.
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            if router_kwargs.get("adapters"):
+                _router = MultiAdapterRouter(**router_kwargs)
+            else:
+                if router_kwargs.get("snapshot_path") is None:
+                    router_kwargs["snapshot_path"] = os.environ.get("ROUTER_SNAPSHOT_PATH")
+                router_kwargs.pop("adapters", None)
+                _router = FinetunedRouter(**router_kwargs)
+    if warm_up:
+        _router.warm_up()
+    return _router
 
-# Generate response
-outputs = model.generate(**inputs, max_new_tokens=5020, use_cache=True)
+def close_router() -> None:
+    """Closes the process-wide router; the next `get_router()` starts a fresh one."""
+    global _router
+    with _router_lock:
+        router, _router = _router, None
+    if router is not None:
+        router.close()
 
-# Decode and process the response
-answer = tokenizer.batch_decode(outputs)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Route one input with the fine-tuned model.")
+    parser.add_argument("text", nargs="?", default=WARM_UP_TEXT)
+    parser.add_argument("--snapshot", help="Load from a snapshot written by --save-snapshot.")
+    parser.add_argument("--save-snapshot", help="Write a quantized, merged snapshot of the model to this directory.")
+    args = parser.parse_args()
 
-# Extract the response after "### Response:"
-answer = answer[0].split("### Response:")[-1].strip()
+    router = get_router(snapshot_path=args.snapshot)
+    if args.save_snapshot:
+        router.save_snapshot(args.save_snapshot)
+        print(f"Snapshot saved to {args.save_snapshot}")
 
-print("Answer of the question is:", answer)
+    # Route the input
+    answer = router.classify_agent(args.text, top_k=3, justify=True)
+    print("Answer of the question is:", json.dumps(answer, indent=4))
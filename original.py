@@ -1,7 +1,7 @@
-import ollama
 import json
-from pydantic import BaseModel, ValidationError, Field
+from pydantic import BaseModel, Field
 from typing import Literal, Optional
+from routecache import RoutingCache
 
 # List of all available agents with descriptions
 AGENTS = {
@@ -72,48 +72,39 @@ class AgentResponse(BaseModel):
     recommended_agent: Optional[Literal[tuple(AGENTS.keys())]] = Field(None, description="Recommended agent, or null if none selected.")
     justification: str = Field(..., description="Reason for selecting the agent, or the reason for refusal.")
 
-def generate_prompt(prompt: str) -> str:
-    """Generates a formatted prompt for the AI model."""
-    agents_json = json.dumps(AGENTS, indent=2)
-    return f"""You are an assistant that strictly outputs JSON-formatted responses. 
-Based on the following user input, select the best agent from the list and provide a justification in JSON format:
-    
-User Input: '{prompt}'
+# Cache of routing decisions, persisted across runs
+ROUTING_CACHE = RoutingCache()
 
-Agents:
-{agents_json}
+# Minimum top-1 vs top-2 similarity margin for the embedding fast path to answer without the LLM
+FAST_PATH_MARGIN = 0.05
 
-Respond with only the following JSON structure:
-{{
-    "recommended_agent": "<agent_name>",
-    "justification": "<reason for selecting the agent>"
-}}
+_routers = {}
 
-Strictly follow this response format.
-"""
+def get_router(margin_threshold: float = None):
+    """
+    The cached Ollama router over `AGENTS` (see router.py), behind the embedding fast path when a
+    `margin_threshold` is given. Built once and reused.
+    """
+    # router.py builds on AGENTS and AgentResponse, so it is imported here rather than at the top
+    import router
+    if "ollama" not in _routers:
+        _routers["ollama"] = router.CachedRouter(router.OllamaRouter(AGENTS, model="llama3.2"), ROUTING_CACHE)
+    if margin_threshold is None:
+        return _routers["ollama"]
+    if "fastpath" not in _routers:
+        _routers["fastpath"] = router.EmbeddingRouter(AGENTS, escalate=_routers["ollama"])
+    _routers["fastpath"].fast_path.margin_threshold = margin_threshold
+    return _routers["fastpath"]
 
-def recommend_agent(prompt: str) -> None:
-    """Processes the prompt and fetches a recommendation from Ollama."""
-    ollama_prompt = generate_prompt(prompt)
-
-    # Call Ollama and get the response
-    response = ollama.chat(model="llama3.2", messages=[{'role': 'user', 'content': ollama_prompt}])
-
-    # Attempt to parse and validate the response
-    try:
-        recommendation = json.loads(response['message']['content'])
-        valid_recommendation = AgentResponse(**recommendation)
-        print(json.dumps(valid_recommendation.dict(), indent=2))
-    except json.JSONDecodeError:
-        # Handle non-JSON response (likely a refusal)
-        refusal_response = AgentResponse(
-            recommended_agent=None,
-            justification="Ollama refused to provide an answer to the prompt."
-        )
-        print(json.dumps(refusal_response.dict(), indent=2))
-    except ValidationError as e:
-        print("Error: Response did not match the expected schema.")
-        print(e.json())
+def recommend_agent(prompt: str, margin_threshold: float = None) -> None:
+    """
+    Processes the prompt and prints the recommendation from Ollama.
+    With a `margin_threshold`, clear-cut prompts are answered by the embedding fast path instead.
+    """
+    recommendation = get_router(margin_threshold).route(prompt)
+    if recommendation["recommended_agent"] is None:
+        print("Error: No agent was recommended.")
+    print(json.dumps(recommendation, indent=2))
 
 # Main program loop for user input
 if __name__ == "__main__":
@@ -122,4 +113,4 @@ if __name__ == "__main__":
         if user_input.lower() == 'exit':
             print("Exiting the program.")
             break
-        recommend_agent(user_input)
+        recommend_agent(user_input, margin_threshold=FAST_PATH_MARGIN)
@@ -1,52 +1,223 @@
 import openai
+import argparse
+import asyncio
+import hashlib
 import json
+import math
+import random
+import re
+import sys
 from dotenv import load_dotenv
 import os
+from retries import is_retryable, retry_delay
 
 # Load environment variables
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-if not openai.api_key:
-    raise ValueError("OpenAI API key is not set. Please add it to the .env file.")
-
 # Load agents from JSON file
 with open("agents.json", "r") as f:
     agents = json.load(f)
 
-def generate_user_prompts(num_prompts=500):
+SYSTEM_PROMPT = (
+    "You are an assistant tasked with creating diverse user prompts. "
+    "Each prompt should ask for advice or assistance that a student might need. This will be used to match to a potential agent later for transfer learning. DO NOT STATE WHICH AGENT WILL BE USED AT IN ANY CIRCUMSTANCE"
+)
+
+# Leading list markers ("1.", "-", "*") and wrapping quotes the model adds around each line
+LIST_MARKER = re.compile(r'^\s*(?:\d+[.)]|[-*•])\s*')
+WORD = re.compile(r"[a-z0-9']+")
+
+def normalize_text(text: str) -> str:
+    return " ".join(WORD.findall(text.lower()))
+
+class NearDuplicateFilter:
     """
-    Generates user prompts dynamically based on the agents list.
+    Rejects exact duplicates (after normalization) and near duplicates by MinHash over word 3-gram shingles,
+    with LSH banding so each check only compares against prompts sharing a band.
     """
-    system_prompt = (
-        "You are an assistant tasked with creating diverse user prompts. "
-        "Each prompt should ask for advice or assistance that a student might need. This will be used to match to a potential agent later for transfer learning. DO NOT STATE WHICH AGENT WILL BE USED AT IN ANY CIRCUMSTANCE"
-    )
-    agents_text = json.dumps(agents, indent=4)
-
-    user_prompts = []
-    for _ in range(num_prompts // 10):  # Generate prompts in batches
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = 0.7, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, self.PRIME), rng.randrange(0, self.PRIME)) for _ in range(num_perm)]
+        self.exact = set()
+        self.buckets = {}
+        self.signatures = []
+
+    def _signature(self, normalized: str) -> tuple:
+        words = normalized.split()
+        shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles]
+        return tuple(min((a * h + b) % self.PRIME for h in hashes) for a, b in self.permutations)
+
+    def add(self, text: str) -> bool:
+        """Records `text` and returns True, or returns False if it duplicates a recorded prompt."""
+        normalized = normalize_text(text)
+        digest = hashlib.sha1(normalized.encode("utf-8")).digest()
+        if not normalized or digest in self.exact:
+            return False
+        signature = self._signature(normalized)
+        band_keys = [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+        candidates = {index for key in band_keys for index in self.buckets.get(key, ())}
+        for index in candidates:
+            other = self.signatures[index]
+            if sum(x == y for x, y in zip(signature, other)) / len(signature) >= self.threshold:
+                return False
+        self.exact.add(digest)
+        self.signatures.append(signature)
+        for key in band_keys:
+            self.buckets.setdefault(key, []).append(len(self.signatures) - 1)
+        return True
+
+def parse_prompts(content: str) -> list:
+    """Splits a completion into one prompt per non-empty line, without list markers or wrapping quotes."""
+    prompts = []
+    for line in content.strip().split("\n"):
+        line = LIST_MARKER.sub("", line).strip().strip('"').strip()
+        if line:
+            prompts.append(line)
+    return prompts
+
+async def request_batch(agent: str, description: str, batch_size: int, max_retries: int, base_delay: float) -> list:
+    """Asks for `batch_size` prompts suited to one agent, retrying transient failures with exponential backoff."""
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": (
+            f"Generate {batch_size} unique prompts, one per line, that this agent would be the best fit for:\n"
+            f"{json.dumps({agent: description}, indent=4)}"
+        )},
+    ]
+    for attempt in range(max_retries + 1):
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Generate 10 unique prompts for these agents:\n{agents_text}"}
-                ],
-                temperature=0.7
-            )
-            batch_prompts = response["choices"][0]["message"]["content"].strip().split("\n")
-            user_prompts.extend(batch_prompts)
+            response = await openai.ChatCompletion.acreate(model="gpt-4", messages=messages, temperature=0.7)
+            return parse_prompts(response["choices"][0]["message"]["content"])
         except Exception as e:
-            print(f"Error generating prompts: {e}")
-    return user_prompts[:num_prompts]
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt, base_delay)
+            print(f"Retrying {agent} batch in {delay:.1f}s after error: {e}", file=sys.stderr)
+            await asyncio.sleep(delay)
+
+async def generate_user_prompts(output_path: str = "prompts.jsonl", num_prompts: int = 500, batch_size: int = 10,
+                                concurrency: int = 8, max_retries: int = 5, base_delay: float = 1.0,
+                                dedup_threshold: float = 0.7, max_stale_batches: int = 3, catalog: dict = None,
+                                target_agents: list = None) -> dict:
+    """
+    Generates prompts into `output_path` (JSONL, one {"agent", "prompt"} record per line) with a per-agent quota.
+    Every accepted prompt is appended as soon as it arrives, and an existing file is resumed rather than overwritten.
+    `catalog` (default: agents.json) sets the quota; `target_agents` limits generation to some of its agents.
+    Returns per-agent counts plus the number of failed batches and rejected duplicates.
+    """
+    catalog = catalog if catalog is not None else agents
+    quota = math.ceil(num_prompts / len(catalog))
+    targets = {agent: catalog[agent] for agent in (target_agents if target_agents is not None else catalog)}
+    counts = {agent: 0 for agent in targets}
+    dedup = NearDuplicateFilter(threshold=dedup_threshold)
+    if os.path.exists(output_path):
+        with open(output_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if dedup.add(record["prompt"]) and record["agent"] in counts:
+                    counts[record["agent"]] += 1
+
+    in_flight = {agent: 0 for agent in targets}
+    stale = {agent: 0 for agent in targets}
+    summary = {"failed_batches": 0, "duplicates": 0}
+
+    def next_agent():
+        # The agent furthest below its quota (counting requests already in flight) goes next
+        open_agents = [
+            agent for agent in targets
+            if stale[agent] < max_stale_batches and counts[agent] + in_flight[agent] * batch_size < quota
+        ]
+        return max(open_agents, key=lambda agent: quota - counts[agent] - in_flight[agent] * batch_size, default=None)
+
+    with open(output_path, "a") as out:
+        async def worker():
+            # Each of the `concurrency` workers keeps exactly one request in flight
+            while True:
+                agent = next_agent()
+                if agent is None:
+                    if any(in_flight.values()):
+                        # A batch still in flight may fail and reopen its agent's quota
+                        await asyncio.sleep(0.05)
+                        continue
+                    return
+                in_flight[agent] += 1
+                try:
+                    prompts = await request_batch(agent, targets[agent], batch_size, max_retries, base_delay)
+                except Exception as e:
+                    print(f"Giving up on a {agent} batch: {e}", file=sys.stderr)
+                    summary["failed_batches"] += 1
+                    stale[agent] += 1
+                    continue
+                finally:
+                    in_flight[agent] -= 1
+
+                accepted = 0
+                for prompt in prompts:
+                    if counts[agent] >= quota:
+                        break
+                    if not dedup.add(prompt):
+                        summary["duplicates"] += 1
+                        continue
+                    out.write(json.dumps({"agent": agent, "prompt": prompt}) + "\n")
+                    counts[agent] += 1
+                    accepted += 1
+                out.flush()
+                # Agents that keep producing nothing new are dropped instead of looping forever
+                stale[agent] = 0 if accepted else stale[agent] + 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return {"counts": counts, **summary}
+
+def export_legacy_prompts(jsonl_path: str, json_path: str) -> int:
+    """Writes the JSONL prompts as the `agent_name: "prompt"` list `generatecleandata.py` reads from prompts.json."""
+    with open(jsonl_path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    with open(json_path, "w") as f:
+        json.dump([f'{record["agent"]}: "{record["prompt"]}"' for record in records], f, indent=4)
+    return len(records)
 
 if __name__ == "__main__":
-    print("Generating user prompts...")
-    prompts = generate_user_prompts(num_prompts=500)
+    parser = argparse.ArgumentParser(description="Generate synthetic user prompts for every agent in agents.json.")
+    parser.add_argument("--num-prompts", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--dedup-threshold", type=float, default=0.7)
+    parser.add_argument("--output", default="prompts.jsonl")
+    parser.add_argument("--legacy-json", default="prompts.json", help="Also export the prompts in the prompts.json format ('' to skip).")
+    parser.add_argument("--api-base", help="OpenAI-compatible endpoint, e.g. a local stub_server.py.")
+    args = parser.parse_args()
 
-    # Save prompts to JSON
-    with open("prompts.json", "w") as f:
-        json.dump(prompts, f, indent=4)
+    if args.api_base:
+        openai.api_base = args.api_base
+        openai.api_key = openai.api_key or "stub"
+    if not openai.api_key:
+        raise ValueError("OpenAI API key is not set. Please add it to the .env file.")
+
+    print("Generating user prompts...")
+    summary = asyncio.run(generate_user_prompts(
+        args.output,
+        num_prompts=args.num_prompts,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        dedup_threshold=args.dedup_threshold,
+    ))
+    print(f"{sum(summary['counts'].values())} prompts in {args.output} "
+          f"({summary['duplicates']} duplicates rejected, {summary['failed_batches']} batches failed)")
 
-    print("Saved 500 user prompts to prompts.json!")
+    if args.legacy_json:
+        count = export_legacy_prompts(args.output, args.legacy_json)
+        print(f"Saved {count} user prompts to {args.legacy_json}!")
@@ -0,0 +1,31 @@
+import random
+
+import httpx
+import ollama
+import openai
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, openai.error.RateLimitError) or getattr(error, "status_code", None) == 429
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors and dropped connections are retried; bad requests, auth errors and bad model output are not."""
+    if is_rate_limited(error):
+        return True
+    if isinstance(error, (openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError)):
+        return True
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+def retry_delay(error: Exception, attempt: int, base_delay: float) -> float:
+    """Honours Retry-After on rate limits, otherwise backs off exponentially with full jitter."""
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if is_rate_limited(error) and retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Rate limits back off from a higher floor than transient failures
+    scale = 4 if is_rate_limited(error) else 1
+    return random.uniform(0, base_delay * scale * 2 ** attempt)
@@ -0,0 +1,181 @@
+import functools
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Trailing punctuation and repeated whitespace do not change which agent a prompt goes to
+TRAILING_PUNCTUATION = re.compile(r"[\s.!?]+$")
+WHITESPACE = re.compile(r"\s+")
+
+def normalize_prompt(prompt: str) -> str:
+    """Canonicalizes a prompt so trivially different spellings share a cache entry."""
+    prompt = unicodedata.normalize("NFKC", prompt).casefold()
+    prompt = WHITESPACE.sub(" ", prompt).strip()
+    return TRAILING_PUNCTUATION.sub("", prompt)
+
+def catalog_fingerprint(catalog) -> str:
+    """Hashes an agent catalog (a dict, or the prompt text it is inlined in)."""
+    if not isinstance(catalog, str):
+        catalog = json.dumps(catalog, sort_keys=True)
+    return hashlib.sha256(catalog.encode("utf-8")).hexdigest()[:16]
+
+class RoutingCache:
+    """
+    Two-tier cache of routing decisions: an in-memory LRU in front of a sqlite file that survives restarts.
+    Entries expire after `ttl_seconds`; each tier evicts its least recently used entries past its size bound.
+    Keys include the catalog fingerprint and backend id, so catalog edits or model swaps never hit stale entries.
+    """
+
+    def __init__(self, path: str = "routing_cache.sqlite", max_memory_entries: int = 10000, max_disk_entries: int = 1000000, ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    @staticmethod
+    def key(prompt: str, catalog, backend: str) -> tuple:
+        """Returns the (cache key, catalog fingerprint) pair for a prompt routed by `backend` over `catalog`."""
+        fingerprint = catalog_fingerprint(catalog)
+        digest = hashlib.sha256(f"{backend}\0{fingerprint}\0{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+        return digest, fingerprint
+
+    def _connect(self) -> sqlite3.Connection:
+        # The file is only opened on first use, so importing a router stays free of side effects
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS decisions ("
+                "key TEXT PRIMARY KEY, catalog TEXT, value TEXT, created REAL, accessed REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS decisions_accessed ON decisions (accessed)")
+        return self._db
+
+    def get(self, key: str):
+        """Returns the cached decision for `key`, or None on a miss or an expired entry."""
+        now = time.time()
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return json.loads(entry[0])
+            self.memory.pop(key, None)
+
+            db = self._connect()
+            row = db.execute("SELECT value, created FROM decisions WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] >= self.ttl_seconds:
+                if row is not None:
+                    db.execute("DELETE FROM decisions WHERE key = ?", (key,))
+                    db.commit()
+                self.misses += 1
+                return None
+            db.execute("UPDATE decisions SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+            self._remember(key, row[0], row[1])
+            self.hits_disk += 1
+            return json.loads(row[0])
+
+    def _remember(self, key: str, value: str, created: float) -> None:
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def set(self, key: str, value: dict, catalog: str = None) -> None:
+        """Stores a decision in both tiers, evicting the least recently used disk entries past the size bound."""
+        now = time.time()
+        serialized = json.dumps(value)
+        with self._lock:
+            self._remember(key, serialized, now)
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?)", (key, catalog, serialized, now, now))
+            (count,) = db.execute("SELECT COUNT(*) FROM decisions").fetchone()
+            if count > self.max_disk_entries:
+                db.execute(
+                    "DELETE FROM decisions WHERE key IN (SELECT key FROM decisions ORDER BY accessed LIMIT ?)",
+                    (count - self.max_disk_entries,)
+                )
+            db.commit()
+
+    def invalidate(self, keep_catalogs: list = None) -> None:
+        """Drops every entry, or only those whose catalog fingerprint is not in `keep_catalogs`."""
+        with self._lock:
+            self.memory.clear()
+            db = self._connect()
+            if keep_catalogs:
+                placeholders = ", ".join("?" for _ in keep_catalogs)
+                db.execute(f"DELETE FROM decisions WHERE catalog NOT IN ({placeholders})", list(keep_catalogs))
+            else:
+                db.execute("DELETE FROM decisions")
+            db.commit()
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and tier sizes."""
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        with self._lock:
+            (disk_entries,) = self._connect().execute("SELECT COUNT(*) FROM decisions").fetchone()
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_entries": disk_entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+def cached(cache: RoutingCache, backend: str, catalog):
+    """
+    Puts `cache` in front of a `prompt -> dict` router function.
+    `catalog` is the agent catalog (or a callable returning it, for catalogs that can change at runtime).
+    Decisions without a recommended agent are not cached, so refusals and parse failures are retried.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(prompt: str) -> dict:
+            key, fingerprint = cache.key(prompt, catalog() if callable(catalog) else catalog, backend)
+            decision = cache.get(key)
+            if decision is None:
+                decision = func(prompt)
+                if decision.get("recommended_agent") is not None:
+                    cache.set(key, decision, fingerprint)
+            return decision
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+def cached_batch(cache: RoutingCache, backend: str, catalog):
+    """Batch counterpart of `cached` for `prompts -> [dict]` router functions: only the misses reach the backend."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(prompts: list) -> list:
+            resolved_catalog = catalog() if callable(catalog) else catalog
+            keys = [cache.key(prompt, resolved_catalog, backend) for prompt in prompts]
+            decisions = [cache.get(key) for key, _ in keys]
+            misses = [i for i, decision in enumerate(decisions) if decision is None]
+            if misses:
+                for i, decision in zip(misses, func([prompts[i] for i in misses])):
+                    decisions[i] = decision
+                    if decision.get("recommended_agent") is not None:
+                        cache.set(keys[i][0], decision, keys[i][1])
+            return decisions
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -0,0 +1,511 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import ollama
+import openai
+from pydantic import ValidationError
+
+import compactdata
+import telemetry
+from fastpath import AgentIndex, FastPathRouter
+from original import AGENTS, AgentResponse
+from routecache import RoutingCache, cached, cached_batch
+
+# Outermost JSON object in a reply, so code fences or a sentence around it do not break parsing
+JSON_OBJECT = re.compile(r"\{.*\}", re.S)
+# The pieces of a response around the agent name and justification, as `compactdata.build_output` renders them
+RESPONSE_HEAD = '{\n    "recommended_agent": "'
+JUSTIFICATION_HEAD = '",\n    "justification": "'
+RESPONSE_TAIL = '"\n}'
+
+class PromptBuilder:
+    """
+    The routing prompt every backend sees: the fine-tuning instruction for the catalog, then the input.
+    Everything but the input is rendered once per catalog.
+    """
+
+    def __init__(self, agents: dict):
+        self.agents = agents
+        self.instruction = compactdata.build_instruction(agents)
+        self.head = self.instruction + "\n\n### Input:\n"
+        self.tail = "\n\n### Response:\n"
+
+    def render(self, prompt: str) -> str:
+        return self.head + prompt + self.tail
+
+    def messages(self, prompt: str) -> list:
+        with telemetry.span("router.prompt_build"):
+            return [{"role": "user", "content": self.render(prompt)}]
+
+def parse_response(content: str, agents: dict = None) -> dict:
+    """
+    Parses a model reply into an `AgentResponse` dict. Replies that are not JSON (usually refusals), do not match
+    the schema, or name an agent outside `agents` come back with a null `recommended_agent` instead of raising.
+    """
+    with telemetry.span("router.parse", chars=len(content)):
+        match = JSON_OBJECT.search(content)
+        try:
+            response = AgentResponse(**json.loads(match.group(0) if match else content))
+        except json.JSONDecodeError:
+            telemetry.count("parse_failures_total", reason="not_json")
+            return {"recommended_agent": None, "justification": "The model refused to provide an answer to the prompt."}
+        except (ValidationError, TypeError) as e:
+            telemetry.count("parse_failures_total", reason="schema")
+            return {"recommended_agent": None, "justification": f"Response did not match the expected schema: {e}"}
+        if agents is not None and response.recommended_agent is not None and response.recommended_agent not in agents:
+            telemetry.count("parse_failures_total", reason="unknown_agent")
+            return {"recommended_agent": None, "justification": f"Recommended agent {response.recommended_agent!r} is not in the catalog."}
+        return response.dict()
+
+def failed_response(error: Exception) -> dict:
+    """Result for a prompt whose backend call raised, so one failure does not sink a whole `route_many` batch."""
+    telemetry.count("route_errors_total", error=type(error).__name__)
+    return {"recommended_agent": None, "justification": "Routing failed.", "error": f"{type(error).__name__}: {error}"}
+
+class Router:
+    """
+    A routing backend over an agent catalog (default: `AGENTS`). `route(prompt)` returns an `AgentResponse`-shaped
+    dict and raises on backend errors; `route_many(prompts)` returns one dict per prompt, reporting failures inline
+    (see `failed_response`). Subclasses override `route_many` with real batching or concurrency.
+    """
+
+    backend = "router"
+
+    def __init__(self, agents: dict = None):
+        self.agents = agents if agents is not None else AGENTS
+        self.prompts = PromptBuilder(self.agents)
+
+    @property
+    def backend_id(self) -> str:
+        """Identifies the backend and model, e.g. for cache keys."""
+        return self.backend
+
+    def route(self, prompt: str) -> dict:
+        return self.route_many([prompt])[0]
+
+    def route_many(self, prompts: list) -> list:
+        return [self._route_or_fail(prompt) for prompt in prompts]
+
+    def route_with_stats(self, prompt: str) -> tuple:
+        """
+        `route` plus whatever the backend can measure about the call: `ttft_s` (time to first token) and
+        `completion_tokens` for backends that stream, nothing for the rest.
+        """
+        return self.route(prompt), {}
+
+    def _route_or_fail(self, prompt: str) -> dict:
+        try:
+            return self.route(prompt)
+        except Exception as e:
+            return failed_response(e)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class OpenAIRouter(Router):
+    """Routes with an OpenAI chat model; `route_many` runs up to `concurrency` requests at once."""
+
+    backend = "openai"
+
+    def __init__(self, agents: dict = None, model: str = "gpt-4", concurrency: int = 8, max_tokens: int = 300):
+        super().__init__(agents)
+        self.model = model
+        self.concurrency = concurrency
+        self.max_tokens = max_tokens
+
+    @property
+    def backend_id(self) -> str:
+        return f"openai:{self.model}"
+
+    def route(self, prompt: str) -> dict:
+        messages = self.prompts.messages(prompt)
+        telemetry.count("routes_total", backend=self.backend)
+        with telemetry.span("openai.request", model=self.model):
+            response = openai.ChatCompletion.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=0,
+            )
+        return parse_response(response["choices"][0]["message"]["content"], self.agents)
+
+    def route_with_stats(self, prompt: str) -> tuple:
+        messages = self.prompts.messages(prompt)
+        start = time.perf_counter()
+        ttft, pieces = None, []
+        telemetry.count("routes_total", backend=self.backend)
+        with telemetry.span("openai.request", model=self.model, stream=True):
+            for chunk in openai.ChatCompletion.create(model=self.model, messages=messages,
+                                                      max_tokens=self.max_tokens, temperature=0, stream=True):
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    ttft = ttft if ttft is not None else time.perf_counter() - start
+                    pieces.append(content)
+        if ttft is not None:
+            telemetry.observe("ttft_seconds", ttft, backend=self.backend)
+        # One streamed chunk per token
+        return parse_response("".join(pieces), self.agents), {"ttft_s": ttft, "completion_tokens": len(pieces)}
+
+    def route_many(self, prompts: list) -> list:
+        with telemetry.span("openai.route_many", rows=len(prompts)), ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self._route_or_fail, prompts))
+
+class OllamaRouter(Router):
+    """
+    Routes with an Ollama model. One pool of persistent connections and the loaded model (`keep_alive`) are kept
+    for the router's lifetime; `route_many` runs on the router's own event loop, with up to `max_in_flight`
+    requests outstanding at once across all callers.
+    """
+
+    backend = "ollama"
+
+    def __init__(self, agents: dict = None, model: str = "llama3.2", host: str = None, max_in_flight: int = 16,
+                 keep_alive: str = "30m", timeout: float = 120.0):
+        super().__init__(agents)
+        self.model = model
+        self.host = host
+        self.max_in_flight = max_in_flight
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.client = ollama.Client(host=host, timeout=timeout, limits=self._limits())
+        # Created on first `route_many`: the loop runs on its own thread, and the async client and semaphore live on it
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        self._async_client = None
+        self._semaphore = None
+
+    @property
+    def backend_id(self) -> str:
+        return f"ollama:{self.model}"
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+
+    def route(self, prompt: str) -> dict:
+        messages = self.prompts.messages(prompt)
+        telemetry.count("routes_total", backend=self.backend)
+        with telemetry.span("ollama.request", model=self.model):
+            response = self.client.chat(model=self.model, messages=messages, keep_alive=self.keep_alive)
+        return parse_response(response["message"]["content"], self.agents)
+
+    def route_with_stats(self, prompt: str) -> tuple:
+        messages = self.prompts.messages(prompt)
+        start = time.perf_counter()
+        ttft, pieces, tokens = None, [], None
+        telemetry.count("routes_total", backend=self.backend)
+        with telemetry.span("ollama.request", model=self.model, stream=True):
+            for chunk in self.client.chat(model=self.model, messages=messages, keep_alive=self.keep_alive, stream=True):
+                if chunk["message"]["content"]:
+                    ttft = ttft if ttft is not None else time.perf_counter() - start
+                    pieces.append(chunk["message"]["content"])
+                if chunk.get("done"):
+                    tokens = chunk.get("eval_count")
+        if ttft is not None:
+            telemetry.observe("ttft_seconds", ttft, backend=self.backend)
+        return parse_response("".join(pieces), self.agents), {"ttft_s": ttft, "completion_tokens": tokens if tokens is not None else len(pieces)}
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="ollama-router", daemon=True)
+                self._loop_thread.start()
+            return self._loop
+
+    async def _route_many(self, prompts: list) -> list:
+        # Runs only on the router's loop, so the client and semaphore need no lock
+        if self._async_client is None:
+            self._async_client = ollama.AsyncClient(host=self.host, timeout=self.timeout, limits=self._limits())
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def route_one(prompt: str) -> dict:
+            try:
+                async with self._semaphore:
+                    telemetry.count("routes_total", backend=self.backend)
+                    # Timed without a span: concurrent coroutines share one thread, so they would nest as parents
+                    start = time.perf_counter()
+                    response = await self._async_client.chat(model=self.model, messages=self.prompts.messages(prompt),
+                                                             keep_alive=self.keep_alive)
+                    telemetry.observe("request_seconds", time.perf_counter() - start, backend=self.backend)
+                return parse_response(response["message"]["content"], self.agents)
+            except Exception as e:
+                return failed_response(e)
+
+        return await asyncio.gather(*(route_one(prompt) for prompt in prompts))
+
+    async def route_many_async(self, prompts: list) -> list:
+        """`route_many` for callers already inside an event loop; the requests still run on the router's loop."""
+        with telemetry.span("ollama.route_many", rows=len(prompts)):
+            return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._route_many(prompts), self._event_loop()))
+
+    def route_many(self, prompts: list) -> list:
+        with telemetry.span("ollama.route_many", rows=len(prompts)):
+            return asyncio.run_coroutine_threadsafe(self._route_many(prompts), self._event_loop()).result()
+
+    def close(self) -> None:
+        with self._loop_lock:
+            loop, thread, self._loop, self._loop_thread = self._loop, self._loop_thread, None, None
+        if loop is not None:
+            if self._async_client is not None:
+                asyncio.run_coroutine_threadsafe(self._async_client.close(), loop).result()
+                self._async_client = self._semaphore = None
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.client.close()
+
+class FinetunedBackend(Router):
+    """
+    Routes with the local fine-tuned model (`inference.get_router()`) by scoring every agent name, `batch_size`
+    prompts per forward pass, over the catalog the model was trained on (`agents`, if given, must match it). With a
+    multi-adapter model (`adapters=` in `router_kwargs`), `adapter` picks the LoRA adapter, which routes over its own catalog.
+    """
+
+    backend = "finetuned"
+
+    def __init__(self, agents: dict = None, batch_size: int = 16, top_k: int = 3, justify: bool = False, adapter: str = None, **router_kwargs):
+        import inference
+        self.model = inference.get_router(**router_kwargs)
+        self.adapter = adapter
+        # The model (or adapter) only knows the catalog it was trained on
+        catalog = self.model.catalog(adapter)
+        if agents is not None and agents != catalog:
+            raise ValueError(f"The catalog does not match the one {adapter or self.model.model_name} was trained on "
+                             "(see incremental.py to update the model)")
+        super().__init__(catalog)
+        # Set on the model rather than the module, so other routers in the process keep their own prompt;
+        # a multi-adapter model swaps in each adapter's template itself
+        if adapter is None and self.model.prompt_template is None:
+            self.model.prompt_template = inference.prompt_from_instruction(self.prompts.instruction)
+        self.batch_size = batch_size
+        self.top_k = top_k
+        self.justify = justify
+
+    @property
+    def backend_id(self) -> str:
+        model_id = self.model.snapshot_path or self.model.model_name
+        return f"finetuned:{model_id}+{self.adapter}" if self.adapter else f"finetuned:{model_id}"
+
+    def route_many(self, prompts: list) -> list:
+        results = []
+        telemetry.count("routes_total", len(prompts), backend=self.backend)
+        for start in range(0, len(prompts), self.batch_size):
+            with self.model.using(self.adapter):
+                batch = self.model.classify_agents(prompts[start:start + self.batch_size], top_k=self.top_k,
+                                                   justify=self.justify, agent_names=list(self.agents))
+            for result in batch:
+                agent = result["recommended_agent"]
+                results.append({
+                    "recommended_agent": agent,
+                    "justification": result.get("justification") or compactdata.default_justification(agent),
+                    "ranking": result["ranking"],
+                })
+        return results
+
+class DistilledBackend(Router):
+    """Routes with the distilled encoder + linear-head classifier (see distill.py), one encoder pass per batch."""
+
+    backend = "distilled"
+
+    def __init__(self, agents: dict = None, path: str = None, top_k: int = 3, **router_kwargs):
+        import distill
+        self.model = distill.DistilledRouter(path or distill.DISTILLED_PATH, **router_kwargs)
+        if agents is None:
+            # The catalog the head was trained over, without loading the encoder
+            with open(os.path.join(self.model.path, "config.json"), "r") as f:
+                agents = {name: AGENTS.get(name, "") for name in json.load(f)["agents"]}
+        super().__init__(agents)
+        self.top_k = top_k
+
+    @property
+    def backend_id(self) -> str:
+        return f"distilled:{self.model.path}"
+
+    def route_many(self, prompts: list) -> list:
+        telemetry.count("routes_total", len(prompts), backend=self.backend)
+        return [{
+            "recommended_agent": result["recommended_agent"],
+            "justification": compactdata.default_justification(result["recommended_agent"]),
+            "ranking": result["ranking"],
+        } for result in self.model.classify_agents(prompts, top_k=self.top_k)]
+
+def gbnf_literal(text: str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+def agent_grammar(agents, justify: bool = False) -> str:
+    """
+    llama.cpp (GBNF) grammar for a response naming one of `agents`: the full JSON response when `justify` is set,
+    otherwise just the name and its closing quote, to be generated after `RESPONSE_HEAD`.
+    """
+    names = " | ".join(gbnf_literal(agent) for agent in agents)
+    if not justify:
+        return "root ::= agent " + gbnf_literal('"') + f"\nagent ::= {names}\n"
+    return (
+        f"root ::= {gbnf_literal(RESPONSE_HEAD)} agent {gbnf_literal(JUSTIFICATION_HEAD)} char* {gbnf_literal(RESPONSE_TAIL)}\n"
+        f"agent ::= {names}\n"
+        r'''char ::= [^"\\\n] | "\\" ["\\/bnrt]''' "\n"
+    )
+
+class LlamaCppBackend(Router):
+    """
+    Routes on CPU with the quantized GGUF export of the fine-tuned model (see export.py) through llama.cpp, with
+    `n_threads` threads. Decoding is constrained to the catalog's agent names and stops after the name unless
+    `justify` is set. llama.cpp reuses the evaluated tokens a prompt shares with the previous one, so the catalog
+    header is prefilled once and each route only prefills its input; routes are therefore run one at a time.
+    """
+
+    backend = "cpu"
+
+    def __init__(self, agents: dict = None, model: str = None, n_threads: int = None, n_ctx: int = 4096, n_batch: int = 512,
+                 justify: bool = False, max_justification_tokens: int = 64):
+        import export
+        self.path = model or export.GGUF_PATH
+        if agents is None:
+            # The catalog recorded with the export
+            _, agents = export.load_export(self.path)
+        super().__init__(agents)
+        self.n_threads = n_threads
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.justify = justify
+        # Agent names take well under 32 tokens
+        self.max_tokens = 32 + (max_justification_tokens if justify else 0)
+        self._llm = None
+        self._grammar = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend_id(self) -> str:
+        return f"cpu:{self.path}"
+
+    def _load(self) -> None:
+        if self._llm is None:
+            import export
+            import llama_cpp
+            model_path, _ = export.load_export(self.path)
+            self._llm = llama_cpp.Llama(model_path=model_path, n_ctx=self.n_ctx, n_batch=self.n_batch, n_threads=self.n_threads,
+                                        n_threads_batch=self.n_threads, verbose=False)
+            self._grammar = llama_cpp.LlamaGrammar.from_string(agent_grammar(self.agents, self.justify), verbose=False)
+
+    def _completion(self, prompt: str, stream: bool = False):
+        self._load()
+        text = self.prompts.render(prompt) + ("" if self.justify else RESPONSE_HEAD)
+        return self._llm.create_completion(text, max_tokens=self.max_tokens, temperature=0, grammar=self._grammar, stream=stream)
+
+    def _result(self, content: str) -> dict:
+        if self.justify:
+            # A justification cut off by the token budget is closed so the agent is still recovered
+            return parse_response(content if content.endswith("}") else content + RESPONSE_TAIL, self.agents)
+        agent = content.removesuffix('"')
+        if agent not in self.agents:
+            telemetry.count("parse_failures_total", reason="unknown_agent")
+            return {"recommended_agent": None, "justification": f"Recommended agent {agent!r} is not in the catalog."}
+        return {"recommended_agent": agent, "justification": compactdata.default_justification(agent)}
+
+    def route(self, prompt: str) -> dict:
+        telemetry.count("routes_total", backend=self.backend)
+        with self._lock, telemetry.span("cpu.generate", threads=self.n_threads):
+            response = self._completion(prompt)
+        return self._result(response["choices"][0]["text"])
+
+    def route_with_stats(self, prompt: str) -> tuple:
+        telemetry.count("routes_total", backend=self.backend)
+        start = time.perf_counter()
+        ttft, pieces = None, []
+        with self._lock, telemetry.span("cpu.generate", threads=self.n_threads, stream=True):
+            for chunk in self._completion(prompt, stream=True):
+                if chunk["choices"][0]["text"]:
+                    ttft = ttft if ttft is not None else time.perf_counter() - start
+                    pieces.append(chunk["choices"][0]["text"])
+        if ttft is not None:
+            telemetry.observe("ttft_seconds", ttft, backend=self.backend)
+        return self._result("".join(pieces)), {"ttft_s": ttft, "completion_tokens": len(pieces)}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._llm is not None and hasattr(self._llm, "close"):
+                self._llm.close()
+            self._llm = self._grammar = None
+
+class EmbeddingRouter(Router):
+    """
+    Embedding fast path (see fastpath.py): clear-cut prompts are answered from the nearest agent description and
+    the rest are escalated, as one batch, to the `escalate` router. Without `escalate` every prompt is answered
+    from the embeddings.
+    """
+
+    backend = "fastpath"
+
+    def __init__(self, agents: dict = None, escalate: Router = None, margin_threshold: float = 0.05,
+                 min_similarity: float = 0.1, embedder=None):
+        super().__init__(agents)
+        self.escalate = escalate
+        if escalate is None:
+            margin_threshold = min_similarity = float("-inf")
+        self.fast_path = FastPathRouter(AgentIndex(self.agents, embedder), escalate=escalate.route if escalate else None,
+                                        margin_threshold=margin_threshold, min_similarity=min_similarity)
+
+    @property
+    def backend_id(self) -> str:
+        return f"fastpath+{self.escalate.backend_id}" if self.escalate else "fastpath"
+
+    def route(self, prompt: str) -> dict:
+        return self.fast_path.route(prompt)
+
+    def route_many(self, prompts: list) -> list:
+        return self.fast_path.route_many(prompts, escalate_many=self.escalate.route_many if self.escalate else None)
+
+    def close(self) -> None:
+        if self.escalate is not None:
+            self.escalate.close()
+
+class CachedRouter(Router):
+    """Puts a `RoutingCache` in front of another router; only cache misses reach it, batched for `route_many`."""
+
+    def __init__(self, router: Router, cache: RoutingCache = None):
+        self.router = router
+        self.cache = cache if cache is not None else RoutingCache()
+        self.agents = router.agents
+        self.prompts = router.prompts
+        self._route = cached(self.cache, router.backend_id, router.agents)(router.route)
+        self._route_many = cached_batch(self.cache, router.backend_id, router.agents)(router.route_many)
+
+    @property
+    def backend_id(self) -> str:
+        return self.router.backend_id
+
+    def route(self, prompt: str) -> dict:
+        return self._route(prompt)
+
+    def route_many(self, prompts: list) -> list:
+        return self._route_many(prompts)
+
+    def close(self) -> None:
+        self.router.close()
+
+BACKENDS = {
+    "openai": OpenAIRouter,
+    "ollama": OllamaRouter,
+    "finetuned": FinetunedBackend,
+    "distilled": DistilledBackend,
+    "cpu": LlamaCppBackend,
+    "fastpath": EmbeddingRouter,
+}
+
+def make_router(name: str, cache: RoutingCache = None, **kwargs) -> Router:
+    """Builds the backend registered as `name`, behind `cache` when one is given."""
+    router = BACKENDS[name](**kwargs)
+    return CachedRouter(router, cache) if cache is not None else router
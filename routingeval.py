@@ -0,0 +1,101 @@
+import json
+import os
+
+import transformers
+import unsloth
+
+import compactdata
+import inference
+
+def load_held_out(data_path: str, indices: list, short_catalog: bool = False) -> list:
+    """
+    The examples at `indices` (positions among the examples of the compact file, as in the token cache) as
+    {"agents", "instruction", "input", "agent"}, with the instruction rendered the way training renders it.
+    """
+    catalogs = compactdata.load_catalogs(data_path)
+    wanted = set(indices)
+    examples = []
+    index = 0
+    for record in compactdata.iter_records(data_path):
+        if record["type"] != "example":
+            continue
+        if index in wanted:
+            catalog = catalogs[record["catalog"]]
+            instruction = compactdata.build_instruction(catalog["agents"], short=True) if short_catalog else catalog["instruction"]
+            examples.append({"agents": catalog["agents"], "instruction": instruction, "input": record["input"], "agent": record["agent"]})
+        index += 1
+    return examples
+
+def routing_accuracy(model, tokenizer, examples: list, batch_size: int = 8) -> float:
+    """
+    Exact-match accuracy of the recommended agent on `examples`, by scoring every agent name after the prompt
+    (`FinetunedRouter.score_agents_batch`), which costs a few forward passes instead of a full generation.
+    """
+    groups = {}
+    for example in examples:
+        groups.setdefault(example["instruction"], []).append(example)
+    correct = 0
+    for instruction, group in groups.items():
+        # A fresh router per evaluation: its cached header past-key-values belong to the weights at that step
+        router = inference.FinetunedRouter.from_loaded(model, tokenizer, group[0]["agents"], inference.prompt_from_instruction(instruction))
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start + batch_size]
+            rankings = router.score_agents_batch([example["input"] for example in batch], agent_names=list(group[0]["agents"]))
+            correct += sum(ranking[0]["agent"] == example["agent"] for ranking, example in zip(rankings, batch))
+    return correct / len(examples) if examples else 0.0
+
+class RoutingAccuracyCallback(transformers.TrainerCallback):
+    """
+    Scores routing accuracy on held-out examples every `eval_steps` optimizer steps and at the end of training.
+    The adapter is saved to `best_path` whenever accuracy improves by more than `min_delta`, and training stops
+    after `patience` evaluations in a row without improvement (0 never stops early).
+    """
+
+    def __init__(self, model, tokenizer, examples: list, eval_steps: int = 10, patience: int = 5, min_delta: float = 0.0,
+                 best_path: str = "output/best", batch_size: int = 8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.examples = examples
+        self.eval_steps = eval_steps
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_path = best_path
+        self.batch_size = batch_size
+        self.best_accuracy = None
+        self.best_step = None
+        self.evals_since_best = 0
+        self.history = []
+
+    def evaluate(self, state, control) -> float:
+        unsloth.FastLanguageModel.for_inference(self.model)
+        try:
+            accuracy = routing_accuracy(self.model, self.tokenizer, self.examples, self.batch_size)
+        finally:
+            unsloth.FastLanguageModel.for_training(self.model)
+        record = {"step": state.global_step, "epoch": state.epoch, "routing_accuracy": accuracy}
+        self.history.append(record)
+        state.log_history.append(dict(record))
+
+        if self.best_accuracy is None or accuracy > self.best_accuracy + self.min_delta:
+            self.best_accuracy, self.best_step, self.evals_since_best = accuracy, state.global_step, 0
+            self.model.save_pretrained(self.best_path)
+            self.tokenizer.save_pretrained(self.best_path)
+            with open(os.path.join(self.best_path, "routing_eval.json"), "w") as f:
+                json.dump({"best": record, "held_out": len(self.examples), "history": self.history}, f, indent=4)
+        else:
+            self.evals_since_best += 1
+            if self.patience and self.evals_since_best >= self.patience:
+                control.should_training_stop = True
+        print(f"Step {state.global_step}: routing accuracy {accuracy:.3f} on {len(self.examples)} held-out examples "
+              f"(best {self.best_accuracy:.3f} at step {self.best_step})")
+        return accuracy
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.eval_steps and state.global_step % self.eval_steps == 0:
+            self.evaluate(state, control)
+        return control
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not self.history or self.history[-1]["step"] != state.global_step:
+            self.evaluate(state, control)
+        return control
@@ -0,0 +1,191 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import inference
+import telemetry
+
+class MicroBatcher:
+    """
+    Collects concurrent routing requests into micro-batches for the fine-tuned router.
+    A batch is dispatched once it holds `max_batch_size` requests or its oldest request waited `max_wait_ms`.
+    Requests for the same adapter run together, the active adapter's first, so adapters switch at most once each.
+    """
+
+    def __init__(self, max_batch_size: int = 16, max_wait_ms: float = 10.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request: dict) -> Future:
+        """Queues one request and returns the future its result will be set on."""
+        future = Future()
+        self.requests.put((request, future))
+        return future
+
+    def _collect(self) -> list:
+        """Blocks for the first request, then gathers more until the batch is full or the wait budget is spent."""
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            # Requests whose caller gave up waiting were cancelled and are skipped; the rest can no longer be cancelled
+            batch = [(request, future) for request, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            telemetry.observe("server_batch_size", len(batch))
+            # Requests only share a forward pass when they need the same kind of work
+            groups = {}
+            for request, future in batch:
+                key = (request["adapter"], request["mode"], request["justify"], request["max_justification_tokens"])
+                groups.setdefault(key, []).append((request, future))
+            router = inference.get_router()
+            order = sorted(groups, key=lambda key: (key[0] != router.active_adapter, str(key[0])))
+            for adapter, mode, justify, max_justification_tokens in order:
+                group = groups[(adapter, mode, justify, max_justification_tokens)]
+                texts = [request["prompt"] for request, _ in group]
+                try:
+                    with router.using(adapter), telemetry.span("server.batch", mode=mode, rows=len(texts)):
+                        if mode == "generate":
+                            results = router.generate_responses(texts, max_justification_tokens)
+                        else:
+                            results = router.classify_agents(texts, justify=justify, max_justification_tokens=max_justification_tokens)
+                except Exception as e:
+                    telemetry.count("route_errors_total", len(group), error=type(e).__name__)
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (request, future), result in zip(group, results):
+                    if "ranking" in result and request["top_k"]:
+                        result["ranking"] = result["ranking"][:request["top_k"]]
+                    future.set_result(result)
+
+def parse_request(body: dict) -> dict:
+    """Validates a `/route` request body and fills in the defaults."""
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object.")
+    prompt = body.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError("'prompt' must be a non-empty string.")
+    mode = body.get("mode", "classify")
+    if mode not in ("classify", "generate"):
+        raise ValueError("'mode' must be 'classify' or 'generate'.")
+    adapter = body.get("adapter")
+    if adapter is not None and not isinstance(adapter, str):
+        raise ValueError("'adapter' must be a string.")
+    return {
+        "prompt": prompt,
+        "adapter": adapter,
+        "mode": mode,
+        "top_k": int(body.get("top_k", 5)),
+        "justify": bool(body.get("justify", False)),
+        "max_justification_tokens": int(body.get("max_justification_tokens", 64)),
+    }
+
+class RouterRequestHandler(BaseHTTPRequestHandler):
+    """Serves `POST /route` through the shared micro-batcher, plus `GET /health`."""
+
+    batcher = None
+    timeout_s = 60.0
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "queued": self.batcher.requests.qsize()})
+        else:
+            self._send_json(404, {"error": "Not found."})
+
+    def do_POST(self):
+        if self.path != "/route":
+            self._send_json(404, {"error": "Not found."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = parse_request(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        future = self.batcher.submit(request)
+        try:
+            result = future.result(timeout=self.timeout_s)
+        except FutureTimeoutError:
+            # A request still queued is dropped from the batcher; one already running finishes unobserved
+            future.cancel()
+            telemetry.count("server_timeouts_total")
+            self._send_json(504, {"error": f"Routing did not finish within {self.timeout_s:g}s."})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, result)
+
+    def log_message(self, format, *args):
+        # Per-request access logs would dominate the output at serving rates
+        pass
+
+def serve(host: str = "127.0.0.1", port: int = 8000, max_batch_size: int = 16, max_wait_ms: float = 10.0, snapshot_path: str = None,
+          telemetry_spec: str = None, adapters: dict = None, max_adapters: int = 4) -> None:
+    """
+    Loads and warms up the router, then serves it until interrupted.
+    With `adapters` (name -> adapter directory) one base model serves them all, selected by each request's "adapter".
+    `telemetry_spec` enables instrumentation (see `telemetry.configure`), defaulting to the ROUTER_TELEMETRY variable.
+    """
+    if telemetry_spec is not None:
+        telemetry.configure(telemetry_spec)
+    else:
+        telemetry.configure_from_env()
+    if adapters:
+        inference.get_router(warm_up=True, adapters=adapters, max_adapters=max_adapters)
+    else:
+        inference.get_router(warm_up=True, snapshot_path=snapshot_path)
+    RouterRequestHandler.batcher = MicroBatcher(max_batch_size, max_wait_ms)
+    server = ThreadingHTTPServer((host, port), RouterRequestHandler)
+    print(f"Router listening on http://{host}:{port} (max batch {max_batch_size}, max wait {max_wait_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        inference.close_router()
+        telemetry.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching HTTP service for the fine-tuned router.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--snapshot", help="Load the model from a snapshot written by `inference.py --save-snapshot`.")
+    parser.add_argument("--telemetry", help="Telemetry exporters, e.g. 'logging,prometheus=router_metrics.prom,otel' (default: $ROUTER_TELEMETRY).")
+    parser.add_argument("--adapters", help="JSON file mapping adapter names to LoRA adapter directories, served over one base model.")
+    parser.add_argument("--max-adapters", type=int, default=4, help="Adapters kept in GPU memory at once (least recently used are evicted).")
+    args = parser.parse_args()
+    adapters = None
+    if args.adapters:
+        with open(args.adapters, "r") as f:
+            adapters = json.load(f)
+    serve(args.host, args.port, args.max_batch_size, args.max_wait_ms, args.snapshot, args.telemetry, adapters, args.max_adapters)
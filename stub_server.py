@@ -0,0 +1,188 @@
+import argparse
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Load agents from JSON file
+with open("agents.json", "r") as f:
+    agents = json.load(f)
+
+PROMPT_COUNT = re.compile(r"Generate (\d+)")
+AGENT_KEY = re.compile(r'"(\w+)":')
+TOPICS = ["a project", "my exams", "next semester", "a deadline", "my budget", "a presentation", "my schedule", "a new hobby"]
+
+def stub_prompts(content: str) -> str:
+    """Fakes a prompt-generation completion: numbered lines mentioning the requested agent's description."""
+    count = int(PROMPT_COUNT.search(content).group(1)) if PROMPT_COUNT.search(content) else 10
+    names = [name for name in AGENT_KEY.findall(content) if name in agents] or list(agents)
+    lines = []
+    for i in range(count):
+        description = agents[random.choice(names)].split(",")[0].lower()
+        lines.append(f'{i + 1}. "Could you help me with {random.choice(TOPICS)}? I need someone who {description} (request {random.getrandbits(32):08x})."')
+    return "\n".join(lines)
+
+def stub_recommendation(content: str) -> str:
+    """Fakes a routing completion: the agent whose name shares the most words with the user input."""
+    user_input = content.split("### Input:")[-1].split("### Response:")[0] if "### Input:" in content else content
+    words = set(re.findall(r"[a-z]+", user_input.lower()))
+    agent = max(agents, key=lambda name: len(words & set(name.split("_"))))
+    return json.dumps({
+        "recommended_agent": agent,
+        "justification": f"The user query matches the functionality of the {agent.replace('_', ' ')}.",
+    }, indent=4)
+
+def stub_completion(messages: list) -> str:
+    content = "\n".join(message.get("content", "") for message in messages)
+    if "recommended_agent" in content:
+        return stub_recommendation(content)
+    return stub_prompts(content)
+
+def stub_chunks(content: str) -> list:
+    """Splits a completion into word-sized pieces to stream, one per fake token."""
+    return re.findall(r"\s*\S+", content) or [content]
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the OpenAI chat completions API (`POST /v1/chat/completions`) and Ollama's chat API
+    (`POST /api/chat`), streaming or not, with configurable time to first token, per-token delay and
+    a rate of injected 429/500 errors to exercise retries.
+    """
+
+    protocol_version = "HTTP/1.1"
+    latency_s = 0.0
+    token_s = 0.0
+    error_rate = 0.0
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, content_type: str, events) -> None:
+        """Streams `events` (encoded chunks) with chunked transfer encoding, `token_s` apart."""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, event in enumerate(events):
+            if i:
+                time.sleep(self.token_s)
+            self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _openai_chat(self, body: dict) -> None:
+        content = stub_completion(body.get("messages", []))
+        chunks = stub_chunks(content)
+        completion_id = f"chatcmpl-stub-{random.getrandbits(32):08x}"
+        if not body.get("stream"):
+            time.sleep(self.token_s * (len(chunks) - 1))
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(chunks), "total_tokens": len(chunks)},
+            })
+            return
+
+        def events():
+            for i, chunk in enumerate(chunks + [None]):
+                delta = {"content": chunk} if chunk is not None else {}
+                if i == 0:
+                    delta["role"] = "assistant"
+                yield b"data: " + json.dumps({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None if chunk is not None else "stop"}],
+                }).encode("utf-8") + b"\n\n"
+            yield b"data: [DONE]\n\n"
+        self._send_stream("text/event-stream", events())
+
+    def _ollama_chat(self, body: dict) -> None:
+        content = stub_completion(body.get("messages", []))
+        chunks = stub_chunks(content)
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in body.get("messages", []))
+
+        def message(text: str, done: bool) -> dict:
+            record = {
+                "model": body.get("model", "stub"),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "message": {"role": "assistant", "content": text},
+                "done": done,
+            }
+            if done:
+                record.update(done_reason="stop", prompt_eval_count=prompt_tokens, eval_count=len(chunks))
+            return record
+
+        # Ollama streams unless told otherwise
+        if body.get("stream", True) is False:
+            time.sleep(self.token_s * (len(chunks) - 1))
+            self._send_json(200, message(content, True))
+            return
+        events = [json.dumps(message(chunk, False)).encode("utf-8") + b"\n" for chunk in chunks]
+        events.append(json.dumps(message("", True)).encode("utf-8") + b"\n")
+        self._send_stream("application/x-ndjson", events)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.latency_s)
+        if random.random() < self.error_rate:
+            status = random.choice([429, 500])
+            self._send_json(status, {"error": {"message": "Injected stub failure.", "type": "stub_error", "code": status}})
+            return
+
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            self._openai_chat(body)
+        elif path == "/api/chat":
+            self._ollama_chat(body)
+        else:
+            self._send_json(404, {"error": {"message": "Not found."}})
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 stalls bursts of new connections from concurrent clients
+    request_queue_size = 128
+    daemon_threads = True
+
+def serve(host: str = "127.0.0.1", port: int = 8001, latency_ms: float = 0.0, error_rate: float = 0.0, token_ms: float = 0.0) -> StubServer:
+    """
+    Creates the stub server; call `serve_forever()` on it (or run it in a thread for tests).
+    `latency_ms` is the time to first token and `token_ms` the delay between streamed tokens.
+    """
+    StubHandler.latency_s = latency_ms / 1000
+    StubHandler.token_s = token_ms / 1000
+    StubHandler.error_rate = error_rate
+    return StubServer((host, port), StubHandler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI and Ollama chat APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--token-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency_ms, args.error_rate, args.token_ms)
+    print(f"Stub OpenAI API on http://{args.host}:{args.port}/v1, Ollama API on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
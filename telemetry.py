@@ -0,0 +1,364 @@
+import atexit
+import bisect
+import logging
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus client defaults plus a finer low end
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Prefix of every exported metric name
+NAMESPACE = "router"
+
+class _NoopSpan:
+    """Returned by `span()` while telemetry is disabled, so instrumented code pays for one flag check."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class Span:
+    """
+    A timed section of the hot path. Its duration lands in the `span_seconds` histogram (labelled by span name)
+    and, with its attributes and parent, is handed to every exporter.
+    """
+
+    __slots__ = ("telemetry", "name", "attributes", "sync", "parent", "start", "start_time_ns", "duration", "error", "exporter_state")
+
+    def __init__(self, telemetry, name: str, sync, attributes: dict):
+        self.telemetry = telemetry
+        self.name = name
+        self.sync = sync
+        self.attributes = attributes
+        self.parent = None
+        self.error = None
+        self.duration = None
+        self.exporter_state = {}
+
+    def set(self, **attributes) -> None:
+        """Adds attributes known only partway through the span (e.g. token counts)."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = self.telemetry._stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        for exporter in self.telemetry.exporters:
+            exporter.start_span(self)
+        self.start_time_ns = time.time_ns()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # GPU work is asynchronous; `sync` (e.g. torch.cuda.synchronize) charges it to this span
+        if self.sync is not None:
+            self.sync()
+        self.duration = time.perf_counter() - self.start
+        self.error = exc_type.__name__ if exc_type is not None else None
+        self.telemetry._stack().pop()
+        self.telemetry._finish(self)
+        return False
+
+class Telemetry:
+    """Process-wide spans, counters and histograms; everything is a no-op until `enable()` is called."""
+
+    def __init__(self):
+        self.enabled = False
+        self.exporters = []
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for exporter in self.exporters:
+            exporter.record("counter", name, value, labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(BUCKETS, value)
+            if index < len(BUCKETS):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+        for exporter in self.exporters:
+            exporter.record("histogram", name, value, labels)
+
+    def _finish(self, span: Span) -> None:
+        self.observe("span_seconds", span.duration, span=span.name)
+        if span.error is not None:
+            self.count("span_errors_total", span=span.name, error=span.error)
+        for exporter in self.exporters:
+            exporter.end_span(span)
+
+    def enable(self, *exporters) -> None:
+        """Turns instrumentation on, adding `exporters` (instrumentation without exporters still keeps the metrics)."""
+        for exporter in exporters:
+            exporter.attach(self)
+            self.exporters.append(exporter)
+        self.enabled = True
+
+    def disable(self) -> None:
+        """Turns instrumentation off after a final flush, and detaches every exporter."""
+        self.flush()
+        self.enabled = False
+        for exporter in self.exporters:
+            exporter.close()
+        self.exporters = []
+
+    def flush(self) -> None:
+        for exporter in self.exporters:
+            exporter.flush()
+
+    def snapshot(self) -> dict:
+        """Copies of the counters and histograms, keyed by (name, sorted label pairs)."""
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {key: {**value, "buckets": list(value["buckets"])} for key, value in self.histograms.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+TELEMETRY = Telemetry()
+
+def span(name: str, sync=None, **attributes):
+    """`with span("finetuned.prefill"):` times a section; free when telemetry is disabled."""
+    if not TELEMETRY.enabled:
+        return _NOOP_SPAN
+    return Span(TELEMETRY, name, sync, attributes)
+
+def count(name: str, value: float = 1, **labels) -> None:
+    if TELEMETRY.enabled:
+        TELEMETRY.count(name, value, **labels)
+
+def observe(name: str, value: float, **labels) -> None:
+    if TELEMETRY.enabled:
+        TELEMETRY.observe(name, value, **labels)
+
+def enabled() -> bool:
+    return TELEMETRY.enabled
+
+def span_summary() -> dict:
+    """Per span name: how often it ran, its total seconds and its mean milliseconds."""
+    summary = {}
+    for (name, labels), histogram in TELEMETRY.snapshot()["histograms"].items():
+        if name == "span_seconds" and histogram["count"]:
+            summary[dict(labels)["span"]] = {
+                "count": histogram["count"],
+                "total_s": histogram["sum"],
+                "mean_ms": 1000 * histogram["sum"] / histogram["count"],
+            }
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["total_s"]))
+
+def flush() -> None:
+    """Pushes the current metrics to every exporter (e.g. rewrites the Prometheus file, logs the summary)."""
+    TELEMETRY.flush()
+
+class Exporter:
+    """Base exporter; subclasses override the hooks they need."""
+
+    def attach(self, telemetry: Telemetry) -> None:
+        self.telemetry = telemetry
+
+    def start_span(self, span: Span) -> None:
+        pass
+
+    def end_span(self, span: Span) -> None:
+        pass
+
+    def record(self, kind: str, name: str, value: float, labels: dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class LoggingExporter(Exporter):
+    """Logs every finished span (at `level`) and, on flush, a summary of the counters and span latencies."""
+
+    def __init__(self, logger: str = f"{NAMESPACE}.telemetry", level: int = logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def end_span(self, span: Span) -> None:
+        if self.logger.isEnabledFor(self.level):
+            parent = f" parent={span.parent.name}" if span.parent is not None else ""
+            error = f" error={span.error}" if span.error else ""
+            self.logger.log(self.level, "span %s %.3fms%s%s %s", span.name, span.duration * 1000, parent, error, span.attributes)
+
+    def flush(self) -> None:
+        snapshot = self.telemetry.snapshot()
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            self.logger.info("counter %s%s = %s", name, dict(labels), value)
+        for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+            if histogram["count"]:
+                self.logger.info("histogram %s%s count=%d mean=%.3fms", name, dict(labels), histogram["count"],
+                                 1000 * histogram["sum"] / histogram["count"])
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+def prometheus_text(snapshot: dict) -> str:
+    """Renders a snapshot in the Prometheus text exposition format."""
+    lines = []
+    counters, histograms = {}, {}
+    for (name, labels), value in snapshot["counters"].items():
+        counters.setdefault(name, []).append((labels, value))
+    for (name, labels), value in snapshot["histograms"].items():
+        histograms.setdefault(name, []).append((labels, value))
+    for name, series in sorted(counters.items()):
+        metric = f"{NAMESPACE}_{name}"
+        lines.append(f"# TYPE {metric} counter")
+        lines.extend(f"{metric}{_format_labels(labels)} {value}" for labels, value in sorted(series))
+    for name, series in sorted(histograms.items()):
+        metric = f"{NAMESPACE}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, histogram in sorted(series, key=lambda item: item[0]):
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, histogram["buckets"]):
+                cumulative += bucket
+                lines.append(f"{metric}_bucket{_format_labels(labels, (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+class PrometheusTextExporter(Exporter):
+    """
+    Writes the metrics to `path` in the Prometheus text format (for node_exporter's textfile collector),
+    every `interval_s` seconds from a background thread, on flush and at exit.
+    """
+
+    def __init__(self, path: str = f"{NAMESPACE}_metrics.prom", interval_s: float = 15.0):
+        self.path = path
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread = None
+
+    def attach(self, telemetry: Telemetry) -> None:
+        super().attach(telemetry)
+        atexit.register(self.flush)
+        if self.interval_s:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.flush()
+
+    def flush(self) -> None:
+        # Written to a temporary file and renamed, so a scraper never reads a partial file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(prometheus_text(self.telemetry.snapshot()))
+        os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        self._stop.set()
+        atexit.unregister(self.flush)
+
+class OpenTelemetryExporter(Exporter):
+    """
+    Mirrors spans, counters and histograms into the OpenTelemetry API (the `opentelemetry-api` package); where
+    they go is up to the SDK and exporters the application configures, e.g. OTLP to a collector.
+    """
+
+    def __init__(self, name: str = NAMESPACE):
+        try:
+            from opentelemetry import context, metrics, trace
+        except ImportError as e:
+            raise ImportError("OpenTelemetryExporter needs the opentelemetry-api package (pip install opentelemetry-api)") from e
+        self.context = context
+        self.trace = trace
+        self.tracer = trace.get_tracer(name)
+        self.meter = metrics.get_meter(name)
+        self.instruments = {}
+        self._lock = threading.Lock()
+
+    def start_span(self, span: Span) -> None:
+        otel_span = self.tracer.start_span(span.name)
+        token = self.context.attach(self.trace.set_span_in_context(otel_span))
+        span.exporter_state[self] = (otel_span, token)
+
+    def end_span(self, span: Span) -> None:
+        otel_span, token = span.exporter_state.pop(self)
+        otel_span.set_attributes({key: value for key, value in span.attributes.items() if isinstance(value, (str, bool, int, float))})
+        if span.error is not None:
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+        self.context.detach(token)
+        otel_span.end()
+
+    def record(self, kind: str, name: str, value: float, labels: dict) -> None:
+        # Span durations are already carried by the spans themselves
+        if name == "span_seconds":
+            return
+        with self._lock:
+            instrument = self.instruments.get((kind, name))
+            if instrument is None:
+                create = self.meter.create_counter if kind == "counter" else self.meter.create_histogram
+                instrument = self.instruments[(kind, name)] = create(f"{NAMESPACE}.{name}")
+        if kind == "counter":
+            instrument.add(value, labels)
+        else:
+            instrument.record(value, labels)
+
+def configure(spec: str) -> None:
+    """
+    Enables telemetry from a comma-separated exporter list, e.g. "logging,prometheus=metrics.prom,otel"
+    (an empty spec or "off" leaves it disabled).
+    """
+    exporters = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, argument = item.partition("=")
+        if name == "off":
+            return
+        if name == "logging":
+            exporters.append(LoggingExporter())
+        elif name == "prometheus":
+            exporters.append(PrometheusTextExporter(argument or f"{NAMESPACE}_metrics.prom"))
+        elif name == "otel":
+            exporters.append(OpenTelemetryExporter())
+        else:
+            raise ValueError(f"Unknown telemetry exporter: {name!r}")
+    if exporters:
+        TELEMETRY.enable(*exporters)
+
+def configure_from_env(variable: str = "ROUTER_TELEMETRY") -> None:
+    """`configure()` from an environment variable, so deployments can turn instrumentation on without code changes."""
+    configure(os.getenv(variable, ""))
@@ -1,105 +1,73 @@
 import openai
-import ollama
 import json
+import logging
+import os
 import pandas as pd
-import inference
-import re
+import router
+import telemetry
+import threading
+from routecache import RoutingCache
 from pydantic import BaseModel, Field
 from typing import Literal, Optional
 
-# Redirect all prints to a file
-import sys
-sys.stdout = open("ftoutput.txt", "w")
+logger = logging.getLogger("router.test")
 
 # API Keys
 openai.api_key = "TOKEN"
 
-# Ensure `data_prompt` is correctly formatted in `inference`
-inference.data_prompt = """You are an assistant that strictly outputs JSON-formatted responses.
-
-Agents:
-{{
-    "academic_agent": "Provides academic guidance, generates research insights, and assists with scholarly writing.",
-    "math_agent": "Solves mathematical problems, explains concepts, and provides tutoring on complex equations.",
-    "cocktail_mixlogist": "Suggests and customizes cocktail recipes based on ingredients and user preferences.",
-    "cook_therapist": "Combines cooking advice with therapeutic insights to make meal prep a relaxing experience.",
-    "creation_agent": "Assists with brainstorming and creating content for writing, art, or other creative projects.",
-    "festival_card_designer": "Designs greeting cards and invitations for festivals and celebrations, customized to themes and styles.",
-    "fitness_trainer": "Provides workout plans, fitness tips, and personalized training advice to meet health goals.",
-    "logo_creator": "Generates logo designs for branding, using customizable templates and artistic styles.",
-    "meme_creator": "Creates memes based on popular formats or user-submitted text for social media engagement.",
-    "music_composer": "Composes original music, generates loops and samples, and customizes tunes based on mood and genre.",
-    "story_teller": "Crafts stories, narratives, and interactive fiction, engaging users with creative storytelling.",
-    "career_coach": "Offers career advice, job interview prep, and professional growth strategies tailored to different industries.",
-    "language_tutor": "Teaches and practices foreign languages, including grammar explanations, conversation, and pronunciation help.",
-    "health_nutritionist": "Provides personalized dietary recommendations, meal planning, and nutritional advice for health and wellness goals.",
-    "coding_helper": "Guides through programming problems, offers coding examples, and explains programming concepts in various languages.",
-    "resume_builder": "Helps create and refine resumes, offers suggestions for improvements, and optimizes formatting for job applications.",
-    "financial_advisor": "Gives financial planning advice, budget creation, and insights on investments and savings strategies.",
-    "travel_planner": "Helps plan vacations and trips, suggests itineraries, and recommends accommodations and activities.",
-    "mental_health_companion": "Offers mental wellness advice, mindfulness practices, and coping mechanisms for stress management.",
-    "sustainability_advisor": "Provides eco-friendly tips, sustainable product recommendations, and helps make greener lifestyle choices.",
-    "parenting_support": "Supports parenting challenges, provides tips for child development, and offers age-appropriate activity ideas.",
-    "pet_care_specialist": "Gives advice on pet care, training tips, and health recommendations for different types of pets.",
-    "fashion_stylist": "Suggests outfits based on trends, occasion, and personal style, providing tips on colors and accessories.",
-    "home_organizer": "Assists with home organization tips, decluttering techniques, and ideas for creating efficient storage spaces.",
-    "garden_guru": "Offers gardening tips, plant care instructions, and seasonal planting advice for indoor and outdoor spaces.",
-    "event_planner": "Assists in planning events, creating schedules, and managing guest lists for celebrations or professional gatherings.",
-    "crypto_analyst": "Provides insights on cryptocurrency trends, trading advice, and explains blockchain concepts in simple terms.",
-    "virtual_therapist": "Offers general mental health advice, listening support, and self-care practices without replacing professional therapy.",
-    "diy_crafter": "Guides users through DIY projects, crafts, and home improvement ideas with step-by-step instructions.",
-    "robotics_expert": "Assists with robotics projects, provides explanations on sensors, motors, and coding for robotics applications.",
-    "urban_gardener": "Gives specialized tips for urban gardening, such as growing plants in small spaces and managing indoor plants."
-}}
-
-Respond with the following JSON structure:
-{{
-    "recommended_agent": "<agent_name>",
-    "justification": "<reason for selecting the agent>"
-}}
-
-### Input:
-{text}
-
-### Response:
-{answer}
-"""
+# Catalog every backend routes over (the one the fine-tuned model was trained on)
+with open("agents.json", "r") as f:
+    CATALOG = json.load(f)
+
+# Routing decisions shared by every backend, keyed on the prompt, the catalog and the backend
+ROUTING_CACHE = RoutingCache()
+
+# One router per backend, all built on the same prompt and response parser (see router.py). Each is built on first
+# use, so CPU-only hosts running the cpu backend never import the GPU backends' torch stack.
+BACKENDS = {
+    "openai": lambda: router.OpenAIRouter(CATALOG, model="gpt-4"),
+    "ollama": lambda: router.OllamaRouter(CATALOG, model="llama3.1"),
+    "finetuned": lambda: router.FinetunedBackend(CATALOG),
+    # Distilled encoder + linear-head router (see distill.py)
+    "distilled": lambda: router.DistilledBackend(CATALOG),
+    # Quantized GGUF export of the fine-tuned model on CPU through llama.cpp (see export.py)
+    "cpu": lambda: router.LlamaCppBackend(CATALOG),
+}
+_routers = {}
+_routers_lock = threading.Lock()
+
+def get_backend_router(backend: str) -> router.CachedRouter:
+    """Returns the cached router for `backend`, building it on first use."""
+    with _routers_lock:
+        if backend not in _routers:
+            _routers[backend] = router.CachedRouter(BACKENDS[backend](), ROUTING_CACHE)
+        return _routers[backend]
 
 def recommend_agent_openai(prompt: str) -> dict:
     """Fetches a recommendation from OpenAI."""
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[{"role": "system", "content": inference.data_prompt.format(text=prompt, answer="")}],
-        max_tokens=300,
-        temperature=0
-    )
-    return json.loads(response['choices'][0]['message']['content'])
+    return get_backend_router("openai").route(prompt)
 
 def recommend_agent_ollama(prompt: str) -> dict:
     """Fetches a recommendation from Ollama."""
-    response = ollama.chat(model="llama3.1", messages=[{'role': 'user', 'content': inference.data_prompt.format(text=prompt, answer="")}])
-    return json.loads(response['message']['content'])
+    return get_backend_router("ollama").route(prompt)
 
 def recommend_agent_finetuned(prompt: str) -> dict:
-    """Fetches a recommendation from the fine-tuned model."""
-    formatted_prompt = inference.data_prompt.format(text=prompt, answer="")
-    inputs = inference.tokenizer([formatted_prompt], return_tensors="pt").to("cuda")
+    """Fetches a recommendation from the fine-tuned model by scoring every agent name."""
+    result = get_backend_router("finetuned").route(prompt)
+    logger.debug("Top agents from Fine-tuned Model: %s", json.dumps(result["ranking"]))
+    return result
 
-    # Generate response
-    outputs = inference.model.generate(**inputs, max_new_tokens=5020, use_cache=True)
-    raw_answer = inference.tokenizer.batch_decode(outputs)[0]
+def recommend_agents_finetuned(prompts: list) -> list:
+    """Fetches recommendations for a batch of prompts from the fine-tuned model in one scoring pass."""
+    return get_backend_router("finetuned").route_many(prompts)
 
-    # Debugging: Print the raw output
-    print(f"Raw Output from Fine-tuned Model:\n{raw_answer}")
-
-    # Extract `recommended_agent` using regex
-    match = re.search(r'"recommended_agent"\s*:\s*"([^"]+)"', raw_answer)
-    if match:
-        return {"recommended_agent": match.group(1)}
-    else:
-        print("Failed to extract recommended_agent from the response.")
-        return {"recommended_agent": None}
+def recommend_agents_distilled(prompts: list) -> list:
+    """Fetches recommendations for a batch of prompts from the distilled classifier in one encoder pass."""
+    return get_backend_router("distilled").route_many(prompts)
 
+def recommend_agents_cpu(prompts: list) -> list:
+    """Fetches recommendations for a batch of prompts from the CPU (llama.cpp) export of the fine-tuned model."""
+    return get_backend_router("cpu").route_many(prompts)
 
 def generate_user_inputs() -> list:
     """Generates a list of 50 diverse prompts for testing."""
@@ -165,7 +133,7 @@ def compare_recommendations():
     matches_finetuned_gpt = 0
 
     for idx, prompt in enumerate(user_inputs, start=1):
-        print(f"Processing {idx}/{len(user_inputs)}: {prompt}")
+        logger.info("Processing %d/%d: %s", idx, len(user_inputs), prompt)
 
         gpt_response = recommend_agent_openai(prompt)
         ollama_response = recommend_agent_ollama(prompt)
@@ -185,13 +153,18 @@ def compare_recommendations():
     gpt_ollama_match_pct = (matches_ollama_gpt / len(user_inputs)) * 100
     finetuned_gpt_match_pct = (matches_finetuned_gpt / len(user_inputs)) * 100
 
-    print(f"\nGPT-4 to Ollama Match Percentage: {gpt_ollama_match_pct:.2f}%")
-    print(f"Fine-tuned to GPT-4 Match Percentage: {finetuned_gpt_match_pct:.2f}%")
+    logger.info("GPT-4 to Ollama Match Percentage: %.2f%%", gpt_ollama_match_pct)
+    logger.info("Fine-tuned to GPT-4 Match Percentage: %.2f%%", finetuned_gpt_match_pct)
 
     df = pd.DataFrame(results)
     df.to_csv("results.csv", index=False)
-    print("Results saved to results.csv")
+    logger.info("Results saved to results.csv")
+    logger.info("Routing cache: %s", json.dumps(ROUTING_CACHE.stats()))
 
 if __name__ == "__main__":
+    # The run log, per-prompt rankings (at DEBUG) and the hot-path timing summary go to ftoutput.txt
+    logging.basicConfig(filename="ftoutput.txt", filemode="w", level=os.getenv("LOG_LEVEL", "INFO"),
+                        format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    telemetry.configure(os.getenv("ROUTER_TELEMETRY", "logging,prometheus=router_metrics.prom"))
     compare_recommendations()
-sys.stdout.close()
+    telemetry.flush()
@@ -0,0 +1,250 @@
+import array
+import bisect
+import hashlib
+import json
+import os
+import random
+import shutil
+
+import numpy as np
+
+import compactdata
+
+# Bump when the on-disk layout or the tokenization scheme changes, so old caches are not reused
+CACHE_VERSION = 2
+CACHE_DIR = "token_cache"
+# Llama 3's vocabulary does not fit in uint16
+TOKEN_DTYPE = np.uint32
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hashes everything about a tokenizer that affects the ids: its serialized model and special tokens."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    state = backend.to_str() if backend is not None else json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.sha256(f"{tokenizer.name_or_path}\0{state}\0{tokenizer.eos_token}".encode("utf-8")).hexdigest()
+
+def cache_key(tokenizer, template: str, data_path: str, short_catalog: bool = False) -> str:
+    parts = [str(CACHE_VERSION), tokenizer_fingerprint(tokenizer), template, file_digest(data_path), str(short_catalog)]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def split_template(template: str) -> list:
+    """Splits the instruction/input/response template into the four literal pieces around its placeholders."""
+    parts = template.split("{}")
+    if len(parts) != 4:
+        raise ValueError("The template needs exactly three {} placeholders (instruction, input, response)")
+    return parts
+
+def _common_prefix_length(a: list, b: list) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def iter_token_ids(tokenizer, template: str, data_path: str, short_catalog: bool = False, batch_size: int = 1000):
+    """
+    Yields `(token_ids, response_start)` for every formatted example (template + eos) in `data_path`, where
+    `response_start` is the number of prompt tokens before the response.
+    The catalog header is tokenized once per catalog and only the short per-row suffixes are tokenized in batches;
+    the split is checked against a full tokenization first and abandoned for a catalog where it would change the ids.
+    """
+    parts = split_template(template)
+    header_ids = {}
+
+    def flush(batch):
+        suffix_ids = tokenizer([suffix for _, _, suffix in batch], add_special_tokens=False)["input_ids"]
+        prompt_ids = tokenizer([prompt for _, prompt, _ in batch], add_special_tokens=False)["input_ids"]
+        for (header, prompt, suffix), ids, prompt_part in zip(batch, suffix_ids, prompt_ids):
+            if header_ids[header] is None:
+                ids = tokenizer(header + suffix)["input_ids"]
+                yield ids, _common_prefix_length(ids, tokenizer(header + prompt)["input_ids"])
+            else:
+                # A token merged across the prompt/response boundary counts as prompt
+                yield header_ids[header] + ids, len(header_ids[header]) + _common_prefix_length(ids, prompt_part)
+
+    batch = []
+    for example in compactdata.iter_examples(data_path, short=short_catalog):
+        header = parts[0] + example["instruction"] + parts[1]
+        prompt = example["input"] + parts[2]
+        suffix = prompt + example["output"] + parts[3] + tokenizer.eos_token
+        if header not in header_ids:
+            ids = tokenizer(header)["input_ids"]
+            joined = ids + tokenizer(suffix, add_special_tokens=False)["input_ids"]
+            header_ids[header] = ids if joined == tokenizer(header + suffix)["input_ids"] else None
+        batch.append((header, prompt, suffix))
+        if len(batch) == batch_size:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
+
+def build_cache(tokenizer, template: str, data_path: str, cache_dir: str = CACHE_DIR, short_catalog: bool = False) -> str:
+    """
+    Tokenizes `data_path` into `cache_dir/<key>/` unless a cache for this tokenizer, template, data and catalog
+    rendering already exists.
+    Token ids are streamed to a flat binary file, so memory use does not grow with the dataset. Returns the cache path.
+    """
+    path = os.path.join(cache_dir, cache_key(tokenizer, template, data_path, short_catalog))
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return path
+
+    # Built under a temporary name and renamed, so an interrupted run never leaves a half-written cache behind
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    lengths = array.array("q")
+    response_starts = array.array("q")
+    with open(os.path.join(tmp_path, "tokens.bin"), "wb") as f:
+        for ids, response_start in iter_token_ids(tokenizer, template, data_path, short_catalog):
+            np.asarray(ids, dtype=TOKEN_DTYPE).tofile(f)
+            lengths.append(len(ids))
+            response_starts.append(response_start)
+    np.save(os.path.join(tmp_path, "lengths.npy"), np.frombuffer(lengths, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "response_starts.npy"), np.frombuffer(response_starts, dtype=np.int64))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "version": CACHE_VERSION,
+            "tokenizer": tokenizer.name_or_path,
+            "template": template,
+            "data_path": data_path,
+            "short_catalog": short_catalog,
+            "examples": len(lengths),
+            "tokens": int(sum(lengths)),
+            "dtype": np.dtype(TOKEN_DTYPE).name,
+        }, f, indent=4)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+class TokenCache:
+    """
+    Read-only, memory-mapped view of a cache built by `build_cache`; `cache[i]` is example i's token ids and
+    `cache.response_starts[i]` the number of its prompt tokens.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode="r")
+        self.response_starts = np.load(os.path.join(path, "response_starts.npy"), mmap_mode="r")
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype=self.meta["dtype"], mode="r") \
+            if self.meta["tokens"] else np.zeros(0, dtype=self.meta["dtype"])
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+def split_indices(count: int, held_out_fraction: float, seed: int = 0) -> tuple:
+    """Deterministically splits example indices into sorted `(train, held_out)` lists."""
+    order = list(range(count))
+    random.Random(seed).shuffle(order)
+    held_out = max(1, int(count * held_out_fraction)) if held_out_fraction and count > 1 else 0
+    return sorted(order[held_out:]), sorted(order[:held_out])
+
+class PackedDataset:
+    """
+    Training dataset of fixed-length blocks cut from the concatenated examples (each already ends in eos),
+    the same packing SFTTrainer's ConstantLengthDataset does, but read straight from the memory map.
+    With `indices`, only those examples are concatenated.
+    """
+
+    def __init__(self, cache: TokenCache, block_size: int, indices: list = None):
+        self.cache = cache
+        self.block_size = block_size
+        self.starts = None
+        if indices is not None:
+            indices = np.asarray(indices, dtype=np.int64)
+            self.starts = cache.offsets[indices]
+            # Position of each selected example in the concatenation
+            self.positions = np.concatenate([[0], np.cumsum(cache.lengths[indices])])
+
+    def __len__(self) -> int:
+        total = len(self.cache.tokens) if self.starts is None else int(self.positions[-1])
+        return total // self.block_size
+
+    def __getitem__(self, index: int) -> dict:
+        start = index * self.block_size
+        if self.starts is None:
+            ids = self.cache.tokens[start:start + self.block_size].astype(np.int64).tolist()
+        else:
+            ids = []
+            example = int(np.searchsorted(self.positions, start, side="right")) - 1
+            while len(ids) < self.block_size:
+                skip = start + len(ids) - int(self.positions[example])
+                end = int(self.starts[example] + self.positions[example + 1] - self.positions[example])
+                ids += self.cache.tokens[self.starts[example] + skip:end][:self.block_size - len(ids)].astype(np.int64).tolist()
+                example += 1
+        return {"input_ids": ids, "attention_mask": [1] * len(ids)}
+
+def auto_max_length(cache: TokenCache, multiple: int = 64) -> int:
+    """The longest example rounded up to `multiple`: the tightest sequence length that truncates nothing."""
+    longest = int(cache.lengths.max()) if len(cache) else multiple
+    return -(-longest // multiple) * multiple
+
+def pack_by_length(lengths, max_length: int) -> list:
+    """
+    Best-fit-decreasing bin packing of example indices into groups whose total length is at most `max_length`.
+    Examples longer than `max_length` are left out.
+    """
+    order = sorted((i for i in range(len(lengths)) if lengths[i] <= max_length), key=lambda i: -int(lengths[i]))
+    groups = []
+    # Sorted (remaining capacity, group index) of every group that still has room
+    open_groups = []
+    for i in order:
+        length = int(lengths[i])
+        position = bisect.bisect_left(open_groups, (length, -1))
+        if position < len(open_groups):
+            remaining, group = open_groups.pop(position)
+        else:
+            remaining, group = max_length, len(groups)
+            groups.append([])
+        groups[group].append(i)
+        if remaining - length > 0:
+            bisect.insort(open_groups, (remaining - length, group))
+    return groups
+
+class MaskedDataset:
+    """
+    Training dataset whose labels cover only the response tokens (prompt tokens are -100), so the loss ignores the
+    instruction and input. Each example is its own sequence of at most `max_length` tokens (default:
+    `auto_max_length`), left to `group_by_length` batching; with `pack`, examples are bin-packed by actual length
+    into sequences of at most `max_length` tokens, which only helps when `max_length` fits several examples.
+    With `indices`, only those examples are used. Examples longer than `max_length` are skipped and counted in `dropped`.
+    """
+
+    def __init__(self, cache: TokenCache, max_length: int = None, pack: bool = False, mask_prompt: bool = True, indices: list = None):
+        self.cache = cache
+        self.max_length = max_length or auto_max_length(cache)
+        self.mask_prompt = mask_prompt
+        indices = list(range(len(cache))) if indices is None else list(indices)
+        if pack:
+            groups = pack_by_length([cache.lengths[i] for i in indices], self.max_length)
+            self.groups = [[indices[i] for i in group] for group in groups]
+        else:
+            self.groups = [[i] for i in indices if cache.lengths[i] <= self.max_length]
+        self.dropped = len(indices) - sum(len(group) for group in self.groups)
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    def __getitem__(self, index: int) -> dict:
+        input_ids, labels = [], []
+        for i in self.groups[index]:
+            ids = self.cache[i].astype(np.int64).tolist()
+            input_ids += ids
+            if self.mask_prompt:
+                start = int(self.cache.response_starts[i])
+                labels += [-100] * start + ids[start:]
+            else:
+                labels += ids
+        return {"input_ids": input_ids, "attention_mask": [1] * len(input_ids), "labels": labels}